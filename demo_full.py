@@ -38,8 +38,8 @@ class AnimatedGif:
 ##############################################################
 class gMonitor(object):
 
-    def __init__(self):
-        self.sender = util.oMsg(zmq.Context(), util.MONITOR_GRAPH, host = "*", conflate = True)
+    def __init__(self, stamp = False): # stamp: add send time, so the viewer can measure latency
+        self.sender = util.oMsg(zmq.Context(), util.MONITOR_GRAPH, host = "*", conflate = True, stamp = stamp)
         self.msg = {}
 
     def stack(self, name, leftscale, leftvars, rightscale, rightvars, datavars):
@@ -53,8 +53,8 @@ class gMonitor(object):
 ##############################################################
 class vMonitor():
         
-    def __init__(self):
-        self.sender = util.oMsg(zmq.Context(), util.MONITOR_VIDEO, host = "*", conflate = True)
+    def __init__(self, stamp = False): # stamp: add send time, so the viewer can measure latency
+        self.sender = util.oMsg(zmq.Context(), util.MONITOR_VIDEO, host = "*", conflate = True, binary = True, stamp = stamp) # frames are RGB
         self.msg = {}
             
     def stack(self, name, frame): # keep the latest for each window type
@@ -68,8 +68,8 @@ class vMonitor():
 # MAIN
 ##############################################################
 if __name__ == '__main__':
-    gmonitor = gMonitor()
-    vmonitor = vMonitor()
+    gmonitor = gMonitor(stamp = True)
+    vmonitor = vMonitor(stamp = True)
 
     options_g = {}
     options_v = {}
@@ -1,15 +1,16 @@
 import sys
-import cv2
 import time
 import math
 import numpy as np
 import util
+import metrics
+import collections
 
 ############################################################################
 # Left or right side panel with y-axis values 
 ############################################################################
 class Scale(object):
-    def __init__(self, scaledef, box, pos, fontsize = 0.3, fonttype = 2):
+    def __init__(self, scaledef, box, pos, fontsize = 0.3, fonttype = 2, auto = False): # auto: autoscale if scaledef has no range
         self.scaledef = scaledef
         self.box      = box
         self.fontsize = fontsize
@@ -17,14 +18,21 @@ class Scale(object):
         self.pos      = pos # position: 0 is left, 1 is right
         self.idx      = 0
         
-        (label_width, self.label_height), baseline = cv2.getTextSize("0123456789", self.fonttype, self.fontsize, 1)
+        (label_width, self.label_height), baseline = util.textcache.size("0123456789", self.fonttype, self.fontsize)
 
-        self.minv = min(self.scaledef.get('min', -1), self.scaledef.get('max', 1))
-        self.maxv = max(self.scaledef.get('max', 1), self.scaledef.get('max', 1))
+        # autoscale: range follows the extremes of the visible window
+        self.auto = self.scaledef.get('auto', auto and 'min' not in self.scaledef and 'max' not in self.scaledef)
+        self.extremes = Extremes() if self.auto else None
+
+        self.label = self.scaledef.get('label', "")
+        self.setrange(min(self.scaledef.get('min', -1), self.scaledef.get('max', 1)), max(self.scaledef.get('max', 1), self.scaledef.get('max', 1)))
+
+    def setrange(self, minv, maxv):
+        self.minv = minv
+        self.maxv = maxv
         if self.minv == self.maxv:
            self.minv = -1
            self.maxv = 1
-        self.label = self.scaledef.get('label', "")
 
         self.labelvals = self.autolabels()
         self.labelstepcnt = len(self.labelvals)-1
@@ -34,7 +42,9 @@ class Scale(object):
 
         # calculate pix offset for each label value. correct sbheight for label_height
         self.steppix = [ int(i * (self.gridheight() / self.labelstepcnt)+self.gridmargin()) for i in range(0, self.labelcnt)]
-   
+
+        if self.box.win is not None: # rescaled - repaint
+            self.box.win[:] = self.box.fill
         self.initscale()
 
     def gridmargin(self):
@@ -45,25 +55,25 @@ class Scale(object):
 
     def initscale(self):
         # print rotated scale label
-        (label_width, label_height), baseline = cv2.getTextSize(self.label, self.fonttype, 1.3 * self.fontsize, 1)
+        (label_width, label_height), baseline = util.textcache.size(self.label, self.fonttype, 1.3 * self.fontsize)
         offs_x = max(0, int(self.box.sbheight()/2 - label_width/2))
         offs_y = label_height if self.pos == 0 else self.box.sbwidth() - 2 # - label_height
         self.box.print(self.label, offs_x, offs_y, self.fonttype, 1.3 * self.fontsize, (120,120,120), rotation = 90) # clockwise 
 
         # now, print scale values
         for i, label in zip(self.steppix, self.labelvals):
-           (label_width, label_height), baseline = cv2.getTextSize(label, self.fonttype, self.fontsize, 1)
+           (label_width, label_height), baseline = util.textcache.size(label, self.fonttype, self.fontsize)
            offs_x = 2 if self.pos == 1 else max(0, self.box.sbwidth()- label_width - 2)
            offs_y = self.box.sbheight() - i + int(label_height/2) 
            self.box.print(label, offs_x, offs_y, self.fonttype, self.fontsize, (120,120,120))
            self.box.win[:,-1 if self.pos == 0 else 0] = 120
 
-    def autolabels(self):  
+    def labelstep(self, minv, maxv): # preferred label count and step size for a range
         labcntprefs = np.array([1, 2, 3, 5, 10, 20])
         labelcnt = labcntprefs[np.where((labcntprefs < round((0.6 * self.gridheight())/self.label_height)) == True)[0][-1]] # preferred max number of labels, given the height
 
         unitprefs = np.array([1, 2, 5, 10]) # preferred label stepsize
-        diff= (self.maxv - self.minv)/labelcnt
+        diff= (maxv - minv)/labelcnt
 
         while True:
            if diff< min(unitprefs):
@@ -73,8 +83,44 @@ class Scale(object):
            else:
                step = unitprefs[np.argmax(unitprefs >= diff)]
                break
+        return labelcnt, step
+
+    def autolabels(self):  
+        labelcnt, step = self.labelstep(self.minv, self.maxv)
         return {} if labelcnt <= 1 else ["{:0.4g}".format(i*step) for i in range(math.floor(self.minv/step), math.ceil(self.maxv/step)+1)]
 
+    def track1(self, x, vlist): # autoscale: one sample per trace, at absolute column x
+        if self.extremes is not None:
+            self.extremes.push1(x, vlist)
+
+    def track(self, xs, samples): # autoscale: samples ( traces x samples ) at absolute columns xs
+        if self.extremes is not None:
+            self.extremes.push(xs, samples)
+
+    def autoscale(self, x0, fit = True): # fit the range to the extremes from column x0 on. returns True if the range changed
+        if self.extremes is None:
+            return False
+        self.extremes.expire(x0)
+        if not fit:
+            return False
+        lohi = self.extremes.range()
+        return lohi is not None and self.fit(*lohi)
+
+    def fit(self, lo, hi): # nice range for lo..hi, with hysteresis. returns True if the range changed
+        if not self.auto or not (math.isfinite(lo) and math.isfinite(hi)):
+            return False
+        span = self.maxv - self.minv
+        if lo >= self.minv and hi <= self.maxv and (hi - lo) > 0.4 * span: # fits and uses the range well enough
+            return False
+        pad = 0.1 * (hi - lo) if hi > lo else 0.1 * max(abs(hi), 1) # headroom, so slow drifts don't rescale at every step
+        lo, hi = lo - pad, hi + pad
+        labelcnt, step = self.labelstep(lo, hi)
+        minv, maxv = float(math.floor(lo / step) * step), float(math.ceil(hi / step) * step)
+        if (minv, maxv) == (self.minv, self.maxv) or (self.minv <= minv and maxv <= self.maxv and (maxv - minv) > 0.5 * span):
+            return False # shrink only to half the range or less
+        self.setrange(minv, maxv)
+        return True
+
     def initgrid(self, roller, color):
         roller[:,::-10] = color.grey() # vert grid 
         roller[:,::-20] = color.silver() # vert grid 
@@ -82,30 +128,88 @@ class Scale(object):
            offs_y = self.steppix[i]
            roller[offs_y,:] = color.silver() if i % 2 == 0 else color.grey() # hor grid
 
-    def rollgrid(self, roller, color):
-        if self.idx % 20 == 0:
-           roller[:,-1] = color.silver() # vert grid - last column
-        elif self.idx % 10 == 0:
-           roller[:,-1] = color.grey() # vert grid - last column
-        else:
-           for i in range(0, self.labelcnt, 1):
-              offs_y = self.steppix[i]
-              roller[offs_y,-1] = color.silver() if i % 2 == 0 else color.grey() # hor grid
-        self.idx += 1
+    def rollgrid(self, roller, color, cols): # cols: array of new columns to paint, oldest first
+        if len(cols) == 1: # the common case - skip numpy overhead
+           col = cols[0]
+           if self.idx % 20 == 0:
+              roller[:,col] = color.silver() # vert grid
+           elif self.idx % 10 == 0:
+              roller[:,col] = color.grey() # vert grid
+           else:
+              for i in range(0, self.labelcnt, 1):
+                 roller[self.steppix[i],col] = color.silver() if i % 2 == 0 else color.grey() # hor grid
+           self.idx += 1
+           return
+        idx = self.idx + np.arange(len(cols))
+        hcols = cols[idx % 10 != 0]
+        for i in range(0, self.labelcnt, 1):
+           offs_y = self.steppix[i]
+           roller[offs_y,hcols] = color.silver() if i % 2 == 0 else color.grey() # hor grid
+        roller[:,cols[(idx % 10 == 0) & (idx % 20 != 0)]] = color.grey() # vert grid
+        roller[:,cols[idx % 20 == 0]] = color.silver() # vert grid
+        self.idx += len(cols)
 
     def getdef(self):
         return self.minv, self.maxv, self.labelstepcnt, self.steppix, self.gridheight(), self.gridmargin()
 
-    def flush(self):
-        self.box.flush()
+    def flush(self): # scales are static - only the first flush paints
+        return [d for d in (self.box.flush(),) if d is not None]
+
+############################################################################
+# Sliding window min and max over absolute columns - monotonic deques of
+# ( column, value ), O(1) amortized per sample. the front of lo holds the
+# window minimum, the front of hi the maximum
+############################################################################
+class Extremes(object):
+
+    def __init__(self):
+        self.lo = collections.deque() # values increasing
+        self.hi = collections.deque() # values decreasing
+
+    def push1(self, x, vlist): # one sample per trace
+        vlist = [v for v in vlist if math.isfinite(v)]
+        if len(vlist) == 0:
+            return
+        mn, mx = min(vlist), max(vlist)
+        while self.lo and self.lo[-1][1] >= mn:
+            self.lo.pop()
+        self.lo.append((x, mn))
+        while self.hi and self.hi[-1][1] <= mx:
+            self.hi.pop()
+        self.hi.append((x, mx))
+
+    def push(self, xs, samples): # samples: traces x samples, oldest first
+        finite = np.isfinite(samples)
+        mn = np.where(finite, samples, np.inf).min(axis = 0)
+        mx = np.where(finite, samples, -np.inf).max(axis = 0)
+        # only samples below ( above ) all later ones can ever be the window min ( max )
+        keeplo = mn < np.concatenate((np.minimum.accumulate(mn[::-1])[::-1][1:], [np.inf]))
+        keephi = mx > np.concatenate((np.maximum.accumulate(mx[::-1])[::-1][1:], [-np.inf]))
+        for deq, keep, vals, drop in ((self.lo, keeplo, mn, lambda a, b: a >= b), (self.hi, keephi, mx, lambda a, b: a <= b)):
+            idx = np.flatnonzero(keep)
+            if len(idx) == 0:
+                continue
+            while deq and drop(deq[-1][1], vals[idx[0]]):
+                deq.pop()
+            deq.extend(zip(xs[idx].tolist(), vals[idx].tolist()))
+
+    def expire(self, x0): # forget columns left of x0
+        while self.lo and self.lo[0][0] < x0:
+            self.lo.popleft()
+        while self.hi and self.hi[0][0] < x0:
+            self.hi.popleft()
+
+    def range(self): # window min and max, None if empty
+        return (self.lo[0][1], self.hi[0][1]) if self.lo else None
 
 ############################################################################
 # Data graph
 ############################################################################
 class Graph(object):
 
-    def __init__(self, name, leftscale, rightscale, box, gfontsize = 0.4, dfontsize = 0.35, fonttype = 2):
+    def __init__(self, name, leftscale, rightscale, box, gfontsize = 0.4, dfontsize = 0.35, fonttype = 2, timespan = 0, prev = None):
         self.box = box
+        self.timespan = timespan # time mode: seconds per pixel column. 0: every message advances one column
         self.gfontsize = gfontsize
         self.dfontsize = dfontsize
         self.fonttype = fonttype
@@ -125,15 +229,113 @@ class Graph(object):
         self.basepix = 0
         self.lastlapsed = 0
 
+        # box.win is used as circular column buffer. head is the newest column
+        self.head = self.box.win.shape[1] - 1
+        self.scratch = None # second window, unroll target
+        self.tick = 0    # absolute column number of the head column
+        self.tcol = None # time mode: absolute column number ( = time / timespan ) of the head column
+        self.zoom = 0    # history pyramid level shown, 0: every column, -1: whole session
+
         self.leftscale.initgrid(self.box.win, self.color) # paint grid using left scale properties
 
+        if prev is not None:
+            self.adopt(prev)
+
+    def adopt(self, prev): # take over variables and history of the graph this one replaces ( relayout ), and redraw from history
+        self.datavars, self.leftvars, self.rightvars, self.skipvars = prev.datavars, prev.leftvars, prev.rightvars, prev.skipvars
+        self.color = prev.color
+        self.basetime, self.lastlapsed = prev.basetime, prev.lastlapsed
+        self.tick, self.tcol, self.zoom = prev.tick, prev.tcol, prev.zoom
+        for var in self.leftvars.values():
+            var.rescale(self.leftscale)
+        for var in self.rightvars.values():
+            var.rescale(self.rightscale)
+        self.rerender()
+
+    def rerender(self): # redraw the whole window from variable history
+        w = self.box.win.shape[1]
+        now = self.tcol if self.timespan > 0 else self.tick
+        if w == 0 or now is None:
+            return
+        if self.zoom != 0:
+            return self.zrender(now - (0 if self.timespan > 0 else 2)) # message mode: the newest sample is two columns left of the head
+        self.head = w - 1
+        cols = np.arange(w)
+        self.box.win[:] = self.color.white()
+        self.leftscale.idx = now - w # grid phase follows the absolute column number
+        self.leftscale.rollgrid(self.box.win, self.color, cols)
+        for vars in (self.leftvars, self.rightvars):
+            for var in reversed(vars.values()): # reversed, draw the first vars last so they are on top
+                if var.history is None:
+                    continue
+                var.reset()
+                var.rescale(var.scale)
+                if self.timespan > 0: # min, max, last of each column as three samples
+                    xs, mn, mx, last = var.history.columns.since(now - w + 1)
+                    if len(xs) > 0:
+                        self.tdraw(var, *var.aggregate(np.stack((mn, mx, last), axis = 2).reshape(mn.shape[0], -1), np.repeat(xs, 3)))
+                    continue
+                ts, xs, samples = var.history.since(now - w + 1)
+                if len(xs) > 0:
+                    var.update(self.box.win, samples, self.column(xs - now - 1))
+        self.box.dirty = True
+
+    def setzoom(self, zoom): # history pyramid level to show, 0: every column, -1: whole session
+        if zoom != self.zoom:
+            self.zoom = zoom
+            self.rerender()
+
+    def zlevel(self, newest): # pyramid level index for the zoom setting, None: every column
+        if self.zoom > 0:
+            return min(self.zoom, History.LEVELS) - 1
+        first = min([var.history.first() for var in {**self.leftvars, **self.rightvars}.values() if var.history is not None and var.history.n > 0], default = newest)
+        level = 0
+        while level < History.LEVELS and newest - first >= self.box.win.shape[1] * 4 ** level:
+            level += 1
+        return level - 1 if level > 0 else None
+
+    def zrender(self, newest): # redraw the whole window from the history pyramid, newest column at the right edge
+        w = self.box.win.shape[1]
+        level = self.zlevel(newest)
+        factor = 4 ** (level + 1) if level is not None else 1
+        now = newest // factor
+        self.head = w - 1
+        self.box.win[:] = self.color.white()
+        entries = []
+        for vars in (self.leftvars, self.rightvars):
+            for var in reversed(vars.values()): # reversed, draw the first vars last so they are on top
+                if var.history is None:
+                    continue
+                if level is None and var.history.columns is not None:
+                    entries.append((var,) + var.history.columns.since(now - w + 1))
+                elif level is None:
+                    ts, xs, samples = var.history.since(now - w + 1)
+                    entries.append((var, xs, samples, samples, samples))
+                else:
+                    var.history.fold()
+                    entries.append((var,) + var.history.levels[level].since(now - w + 1))
+        for scale in (self.leftscale, self.rightscale): # autoscale to the extremes of the window
+            lo = min([np.nanmin(mn) for var, xs, mn, mx, last in entries if var.scale is scale and len(xs) > 0], default = math.nan)
+            hi = max([np.nanmax(mx) for var, xs, mn, mx, last in entries if var.scale is scale and len(xs) > 0], default = math.nan)
+            scale.fit(lo, hi)
+        self.leftscale.idx = now - w
+        self.leftscale.rollgrid(self.box.win, self.color, np.arange(w))
+        for var, xs, mn, mx, last in entries:
+            var.reset()
+            var.rescale(var.scale)
+            if len(xs) > 0:
+                var.zdraw(self.box.win, self.column(xs - now - 1), mn, mx, last)
+        label = "1:{}".format(factor)
+        self.box.print(label, 2, self.box.sbheight() - 2, self.fonttype, 0.3, (120,120,120))
+        self.box.dirty = True
+
     def flushglabels(self):
        offset_xl = 2
        offset_xr = 0
        offset_y = 0
 
        for (k, v) in {**self.leftvars}.items():
-          (label_width, label_height), baseline = cv2.getTextSize(k, self.fonttype, self.gfontsize, 1)
+          (label_width, label_height), baseline = util.textcache.size(k, self.fonttype, self.gfontsize)
           if (offset_xl + label_width) > self.box.sbwidth(): # don't paint outside the box
               break
           self.box.print(k, offset_xl, offset_y + label_height, self.fonttype, self.gfontsize,
@@ -142,7 +344,7 @@ class Graph(object):
 
        offset_xr = self.box.sbwidth() - 2
        for (k, v) in {**self.rightvars}.items():
-          (label_width, label_height), baseline = cv2.getTextSize(k, self.fonttype, self.gfontsize, 1)
+          (label_width, label_height), baseline = util.textcache.size(k, self.fonttype, self.gfontsize)
           if (offset_xr - label_width) < offset_xl: # don't paint over leftvars
               break
           self.box.print(k, offset_xr - label_width, offset_y + label_height, self.fonttype, self.gfontsize,
@@ -154,7 +356,7 @@ class Graph(object):
        height = 0
 
        for (k, v) in {**self.datavars}.values():
-           (label_width, label_height), baseline = cv2.getTextSize(k, self.fonttype, self.dfontsize, 1)
+           (label_width, label_height), baseline = util.textcache.size(k, self.fonttype, self.dfontsize)
            width = max(width, label_width)
            height = max(height, label_height)
 
@@ -167,21 +369,31 @@ class Graph(object):
            self.box.print("= {}".format(v), 5 + width, offs_y, self.fonttype, self.dfontsize, (120,120,120), tocanvas = True)
            offs_y += int(1.6 * height)
 
-    def draw_xtime(self):
+    def draw_xtime(self, now = None, n = 1): # n: columns advanced since last call
+        now = time.time() if now is None else now
         if self.basetime is None:
-            self.basetime = time.time()
-        if self.basepix > 0:
-           self.basepix -= 1
-        lapsed = round((time.time() - self.basetime))
+            self.basetime = now
+        self.basepix = max(0, self.basepix - n)
+        lapsed = round((now - self.basetime))
         if lapsed > self.lastlapsed:
            self.lastlapsed = lapsed
            if self.basepix == 0:
                label = "{:d}:{:d}:{:02d}".format(lapsed // 3600, lapsed // 60, lapsed % 60) if lapsed > 3600 else "{:d}:{:02d}".format(lapsed // 60, lapsed % 60)
-               (label_width, label_height), baseline = cv2.getTextSize(label, self.fonttype, 0.3, 1)
+               (label_width, label_height), baseline = util.textcache.size(label, self.fonttype, 0.3)
+               self.unroll() # label may straddle the buffer wrap. happens once per second at most
                self.box.print(label, self.box.sbwidth() - label_width, self.box.sbheight() - 2, self.fonttype, 0.3, (120,120,120))
                self.basepix = int(label_width * 1.4)
 
-    def gupdate(self, msg, scale, vars): 
+    def samples(self, v): # message value as array of traces x samples, plus sample timestamps if sent
+        if isinstance(v, dict): # {"t" : timestamps, "v" : samples}
+            return self.samples(v["v"])[0], np.atleast_1d(np.asarray(v["t"], dtype = float))
+        if np.isscalar(v):
+            return np.array([[v]], dtype = float), None
+        if isinstance(v, np.ndarray): # burst of samples
+            return np.atleast_2d(v).astype(float), None
+        return np.array(v, dtype = float).reshape(-1, 1), None # list: one sample per trace
+
+    def addvars(self, msg, scale, vars):
         for (k, v)  in msg.items():
             if not k in vars: # we haven't see this var before
                 color = self.color.get()
@@ -191,78 +403,429 @@ class Graph(object):
                         self.skipvars[k] = "" # add var to skip list
                     continue
                 vars[k] = GraphVar(k, scale, color)
+
+    def gupdate(self, msg, scale, vars, t, draw = True): # draw: False when zoomed out, the window is redrawn from history on flush
+        self.addvars(msg, scale, vars)
         for (k, v) in reversed(msg.items()): # reversed, draw the first vars last so they are on top
             if k in vars:
-                vars[k].update(self.box.win, [v] if np.isscalar(v) else v)
+                if np.isscalar(v) or isinstance(v, list): # one sample per trace, the common case - skip numpy overhead
+                    vlist = [v] if np.isscalar(v) else v
+                    if len(vlist) == 0:
+                        continue
+                    vars[k].record1(t, self.tick - 2, vlist)
+                    scale.track1(self.tick - 2, vlist)
+                    if draw:
+                        vars[k].update1(self.box.win, vlist, self.column(-3))
+                    continue
+                samples = self.samples(v)[0]
+                n = samples.shape[1]
+                if samples.size == 0: # no samples since the last message
+                    continue
+                xs = self.tick - 1 - n + np.arange(n) # samples end two columns left of the newest column
+                vars[k].record(t, xs, samples)
+                scale.track(xs, samples)
+                if not draw:
+                    continue
+                keep = min(n, self.box.win.shape[1] - 2) # bursts wider than the window: draw the latest
+                vars[k].update(self.box.win, samples[:, n - keep:], self.column(xs[n - keep:] - self.tick - 1))
 
     def dupdate(self, msg):
         for (k, v)  in msg.items():
-           self.datavars[k] = (k, "{: .3f}".format(v)) # set ( and format ) data var value
-
-    def rollgraph(self): # use np.roll for efficient graph updates
-        self.box.win = np.roll(self.box.win, -1, axis=1)
-        self.box.win[:,-1] = self.color.white()
-        self.leftscale.rollgrid(self.box.win, self.color)
-        self.draw_xtime()
-
-    def update(self, lmsg, rmsg, dmsg): # process new message ( = new graph and data values )
-        self.gupdate(lmsg, self.leftscale, self.leftvars)
-        self.gupdate(rmsg, self.rightscale, self.rightvars)
+           self.datavars[k] = (k, "{: .3f}".format(v if np.isscalar(v) else np.ravel(v)[-1])) # set ( and format ) data var value. bursts: show the last
+
+    def column(self, col): # buffer column for a column relative to the right edge, -1 being the newest
+        return (self.head + 1 + col) % max(1, self.box.win.shape[1])
+
+    def unroll(self): # make the circular buffer linear again, newest column last. swaps with a scratch window, no allocation
+        win = self.box.win
+        if self.scratch is None or self.scratch.shape != win.shape:
+            self.scratch = np.empty_like(win)
+        k = self.head + 1
+        self.scratch[:, :win.shape[1] - k] = win[:, k:]
+        self.scratch[:, win.shape[1] - k:] = win[:, :k]
+        self.box.win, self.scratch = self.scratch, win
+        self.head = win.shape[1] - 1
+
+    def rollgraph(self, n = 1): # advance the circular buffer n columns - no copy of the window
+        if n == 0: # only empty bursts
+            return
+        self.tick += n
+        w = self.box.win.shape[1]
+        if n > w: # only the last w columns are visible
+            self.leftscale.idx += n - w
+            n = w
+        cols = self.column(np.arange(n)) if n > 1 else (self.column(0),)
+        self.head = cols[-1]
+        self.box.win[:,cols] = self.color.white()
+        self.leftscale.rollgrid(self.box.win, self.color, cols)
+
+    def burstsize(self, *msgs): # number of samples per var in the messages, arrays carry a burst of samples. no vars: 1, only empty bursts: 0
+        return max([v.shape[-1] if isinstance(v, np.ndarray) and v.ndim > 0 else 1 for msg in msgs for v in msg.values()], default = 1)
+
+    ##########################################################################
+    # time mode - every column covers timespan seconds. samples that land in
+    # the same column are reduced to min/max/last and drawn as vertical span
+    ##########################################################################
+    def tupdate(self, lmsg, rmsg, t, draw = True):
+        w = self.box.win.shape[1]
+        newest = math.floor(t / self.timespan)
+        batches = []
+        for msg, scale, vars in ((lmsg, self.leftscale, self.leftvars), (rmsg, self.rightscale, self.rightvars)):
+            self.addvars(msg, scale, vars)
+            for (k, v) in reversed(msg.items()): # reversed, draw the first vars last so they are on top
+                if k in vars:
+                    samples, ts = self.samples(v)
+                    if samples.size == 0 or (ts is not None and len(ts) == 0): # no samples since the last message
+                        continue
+                    ts = np.full(samples.shape[1], t) if ts is None else vars[k].toreceive(ts, t)
+                    tcols = np.floor(ts / self.timespan).astype(np.int64)
+                    newest = max(newest, tcols.max())
+                    batches.append((vars[k], samples, ts, tcols))
+
+        n = 0
+        if self.tcol is None:
+            self.tcol = newest
+            self.leftscale.idx = newest # grid phase follows the absolute column number
+        elif newest > self.tcol and not draw:
+            self.tcol = newest
+        elif newest > self.tcol:
+            n = min(newest - self.tcol, w)
+            self.rollgraph(n)
+            self.tcol = newest
+
+        for var, samples, ts, tcols in batches:
+            var.record(ts, tcols, samples, columns = True)
+            var.scale.track(tcols, samples)
+            visible = tcols > self.tcol - w
+            if visible.any() and draw:
+                self.tdraw(var, *var.aggregate(samples[:, visible], tcols[visible]))
+        return n
+
+    def tdraw(self, var, tcols, lo, hi, ok): # draw spans for absolute columns, skip the ones that scrolled out
+        offs = tcols - self.tcol
+        visible = offs > -self.box.win.shape[1]
+        var.draw(self.box.win, self.column(offs[visible] - 1), lo[:, visible], hi[:, visible], ok[:, visible])
+
+    def update(self, lmsg, rmsg, dmsg, t = None): # process new message ( = new graph and data values ). t: receive time
+        if self.box.win.shape[1] == 0:
+            return
+        self.box.dirty = True
+        t = time.time() if t is None else t
+        if self.zoom != 0: # zoomed out: only keep history, flush redraws the window
+            if self.timespan > 0:
+                self.tupdate(lmsg, rmsg, t, draw = False)
+            else:
+                self.tick += self.burstsize(lmsg, rmsg)
+                self.gupdate(lmsg, self.leftscale, self.leftvars, t, draw = False)
+                self.gupdate(rmsg, self.rightscale, self.rightvars, t, draw = False)
+            self.dupdate(dmsg)
+            return
+        if self.timespan > 0:
+            n = self.tupdate(lmsg, rmsg, t)
+            self.dupdate(dmsg)
+            self.draw_xtime(t, n)
+            return
+        self.rollgraph(self.burstsize(lmsg, rmsg))
+        self.gupdate(lmsg, self.leftscale, self.leftvars, t)
+        self.gupdate(rmsg, self.rightscale, self.rightvars, t)
         self.dupdate(dmsg)
-        self.rollgraph()
+        self.draw_xtime(t)
+
+    def autoscale(self, fit = True): # fit autoscaled ranges to the visible window. returns True if a range changed
+        newest = self.tcol if self.timespan > 0 else self.tick - 2
+        if newest is None:
+            return False
+        x0 = newest - self.box.win.shape[1] + 1
+        return self.leftscale.autoscale(x0, fit) | self.rightscale.autoscale(x0, fit) # no short circuit, both scales expire
+
+    def flush(self): # returns damage list. unchanged graphs are not copied, labels are repainted on copied graphs only
+        if self.box.dirty and (self.autoscale(fit = self.zoom == 0) or self.zoom != 0): # rescaled or zoomed out: redraw from history, cost follows the window width
+            self.rerender()
+        if self.zoom == 0 and self.timespan > 0 and self.box.dirty: # paint the columns still collecting samples
+            for vars in (self.leftvars, self.rightvars):
+                for var in reversed(vars.values()):
+                    if var.pcol is not None:
+                        self.tdraw(var, *var.pending())
+        damage = self.leftscale.flush() + self.rightscale.flush()
+        graphdamage = self.box.flush(rollofs = self.column(0))
+        if graphdamage is not None:
+            self.flushglabels()
+            self.flushdlabels()
+            damage.append(graphdamage)
+        return damage
 
-    def flush(self):
-        self.leftscale.flush()
-        self.rightscale.flush()
-        self.box.flush()
-        self.flushglabels()
-        self.flushdlabels()
+############################################################################
+# Variable history - fixed capacity ring buffer of samples: receive time,
+# absolute column and value per trace. lets a graph be re-rendered at any
+# size, in one vectorized pass. samples are folded into a min/max pyramid
+# for zoomed out windows: every level reduces 4 columns of the level below
+############################################################################
+class History(object):
+
+    LEVELS = 6 # pyramid levels: 1:4 .. 1:4096 columns
+
+    def __init__(self, traces, capacity = 8192, levels = LEVELS, levelcapacity = 2048, columns = False): # columns: time mode, also keep min/max/last per column
+        self.capacity = capacity
+        self.t = np.zeros(capacity)
+        self.x = np.zeros(capacity, dtype = np.int64)
+        self.v = np.zeros((capacity, traces))
+        self.n = 0 # samples appended so far
+        self.folded = 0 # samples folded into the pyramid so far
+        self.levels = [Level(traces, levelcapacity, 4 ** (i + 1)) for i in range(levels)]
+        self.columns = Level(traces, levelcapacity, 1) if columns else None # bursts of many samples per column would push the window out of the sample ring
+
+    def append1(self, t, x, vlist): # one sample per trace
+        if self.n - self.folded >= self.capacity: # fold before the sample is overwritten
+            self.fold()
+        i = self.n % self.capacity
+        self.t[i] = t
+        self.x[i] = x
+        self.v[i] = vlist
+        self.n += 1
+
+    def append(self, ts, xs, samples): # samples: traces x samples
+        k = samples.shape[1]
+        if k > self.capacity: # only the latest fit
+            ts, xs, samples, k = np.broadcast_to(ts, k)[-self.capacity:], xs[-self.capacity:], samples[:, -self.capacity:], self.capacity
+        if self.n + k - self.folded > self.capacity:
+            self.fold()
+        idx = (self.n + np.arange(k)) % self.capacity
+        self.t[idx] = ts
+        self.x[idx] = xs
+        self.v[idx] = samples.T
+        self.n += k
+        if self.columns is not None:
+            order = np.argsort(xs, kind = 'stable')
+            self.columns.add(xs[order], samples.T[order], samples.T[order], samples.T[order])
+
+    def since(self, x0): # samples from column x0 on, oldest first: times, columns, traces x samples
+        count = min(self.n, self.capacity)
+        idx = (self.n - count + np.arange(count)) % self.capacity
+        idx = idx[self.x[idx] >= x0]
+        return self.t[idx], self.x[idx], self.v[idx].T
+
+    def first(self): # oldest column still held, at any level
+        for level in reversed(self.levels):
+            if level.n > 0:
+                return level.x[(level.n - min(level.n, level.capacity)) % level.capacity] * level.factor
+        return self.x[(self.n - min(self.n, self.capacity)) % self.capacity] if self.n > 0 else None
+
+    def fold(self): # bring the pyramid up to date, in chunks the levels can hold
+        chunk = self.levels[0].capacity // 2
+        self.folded = max(self.folded, self.n - self.capacity)
+        while self.folded < self.n:
+            idx = np.arange(self.folded, min(self.n, self.folded + chunk)) % self.capacity
+            self.levels[0].add(self.x[idx], self.v[idx], self.v[idx], self.v[idx])
+            self.folded += len(idx)
+            for below, level in zip(self.levels, self.levels[1:]):
+                # the newest entry below may have grown since last time - min/max merge again, last is replaced
+                level.add(*below.entries(max(level.src - 1, below.n - below.capacity, 0)))
+                level.src = below.n
+
+class Level(object): # one pyramid level: min/max/last per trace for each group of 4 columns of the level below
+
+    def __init__(self, traces, capacity, factor):
+        self.capacity = capacity
+        self.factor = factor # base columns per entry
+        self.step = min(factor, 4) # columns of the level below per entry
+        self.x = np.zeros(capacity, dtype = np.int64) # column number at this level
+        self.mn = np.zeros((capacity, traces))
+        self.mx = np.zeros((capacity, traces))
+        self.last = np.zeros((capacity, traces))
+        self.n = 0 # entries added so far
+        self.src = 0 # entries of the level below folded so far
+
+    def entries(self, i0): # entries i0 .. newest, as columns of the level below the next one: x, min, max, last
+        idx = np.arange(i0, self.n) % self.capacity
+        return self.x[idx], self.mn[idx], self.mx[idx], self.last[idx]
+
+    def add(self, xs, mn, mx, last): # fold entries of the level below ( oldest first ) into this level
+        if len(xs) == 0:
+            return
+        newest = self.x[(self.n - 1) % self.capacity] if self.n > 0 else None
+        xs = xs // self.step
+        if newest is not None:
+            xs = np.maximum(xs, newest) # late samples go to the newest entry
+        starts = np.flatnonzero(np.concatenate(([True], xs[1:] != xs[:-1])))
+        ends = np.concatenate((starts[1:], [len(xs)])) - 1
+        xs, mn, mx, last = xs[starts], np.minimum.reduceat(mn, starts), np.maximum.reduceat(mx, starts), last[ends]
+        if newest is not None and xs[0] == newest: # merge with the newest entry
+            i = (self.n - 1) % self.capacity
+            self.mn[i] = np.minimum(self.mn[i], mn[0])
+            self.mx[i] = np.maximum(self.mx[i], mx[0])
+            self.last[i] = last[0]
+            xs, mn, mx, last = xs[1:], mn[1:], mx[1:], last[1:]
+        idx = (self.n + np.arange(len(xs))) % self.capacity
+        self.x[idx], self.mn[idx], self.mx[idx], self.last[idx] = xs, mn, mx, last
+        self.n += len(xs)
+
+    def since(self, x0): # entries from column x0 ( at this level ) on, oldest first: columns, min, max, last as traces x entries
+        xs, mn, mx, last = self.entries(max(0, self.n - self.capacity))
+        keep = xs >= x0
+        return xs[keep], mn[keep].T, mx[keep].T, last[keep].T
 
 ############################################################################
 # Graph Var
 ############################################################################
+CLOCKSTEP = 1.0 # seconds: a sample clock offset this much above the estimate is a clock step, not transport delay
+
 class GraphVar(object):
 
     def __init__(self, name, scale, color):
         self.name = name
         self.color = color
-        self.scale = scale
-        self.prev_vlist = None
+        self.history = None
+        self.offset = None # time mode: sample clock to receive clock, seconds
+        self.reset()
+        self.rescale(scale)
 
+    def reset(self): # forget drawing state, not the history
+        self.prev = None # last pixel row per trace, -1: none yet
+
+        # time mode: column still collecting samples, with its min/max/last pixel row per trace
+        self.pcol = None
+        self.pmin = self.pmax = self.plast = None
+
+    def rescale(self, scale):
+        self.scale = scale
         self.minv, self.maxv, self.labelstepcnt, self.steppix, self.gridheight, self.gridmargin = scale.getdef()
 
+    def toreceive(self, ts, t): # sample timestamps of any publisher clock on the receive clock. the smallest receive - sample time seen is the offset ( least transport delay )
+        offset = t - ts.max()
+        if self.offset is None or offset > self.offset + CLOCKSTEP: # first, or the publisher clock stepped back ( e.g. restarted monotonic clock )
+            self.offset = offset
+        self.offset = min(self.offset, offset)
+        return ts + self.offset
+
+    def record(self, ts, xs, samples, columns = False): # keep samples in history. columns: time mode
+        if self.history is None or self.history.v.shape[1] != samples.shape[0]:
+            self.history = History(samples.shape[0], columns = columns)
+        self.history.append(ts, xs, samples)
+
+    def record1(self, t, x, vlist):
+        if self.history is None or self.history.v.shape[1] != len(vlist):
+            self.history = History(len(vlist))
+        self.history.append1(t, x, vlist)
+
     def num_to_range(self, num, inMin, inMax, outMin, outMax):
-        return int(outMin + (float(num - inMin) / float(inMax - inMin) * (outMax - outMin)))
+        return (outMin + ((num - inMin) / float(inMax - inMin) * (outMax - outMin))).astype(int)
 
-    def update(self, roller, vlist):
-        if self.prev_vlist is None:
-           self.prev_vlist = vlist.copy()
-           for i in range(0, len(vlist)):
-              self.prev_vlist[i] = None
+    def update1(self, roller, vlist, col): # one sample per trace
+        if self.prev is None or len(self.prev) != len(vlist):
+           self.prev = np.full(len(vlist), -1)
         for i in range(0, len(vlist)):
            v = vlist[i]
            if v < self.minv or v > self.maxv:
                continue
-           vn = self.num_to_range(v, self.minv, self.maxv, self.gridheight, 0) + self.gridmargin
-           pn = self.prev_vlist[i]
-           if self.prev_vlist[i] is not None:
-               #roller[min(vn, pn): max(vn, pn)+1, -1] = self.color # smoothen graph by connecting prev and current value
-               roller[min(vn, pn): max(vn, pn)+1 + (1 if (min(vn, pn)== max(vn, pn)) else 0) , -2:-1] = self.color # smoothen graph by connecting prev and current value
-           self.prev_vlist[i] = vn
+           vn = int(self.gridheight + (float(v - self.minv) / float(self.maxv - self.minv) * (0 - self.gridheight))) + self.gridmargin
+           pn = self.prev[i]
+           if pn >= 0:
+               roller[min(vn, pn): max(vn, pn)+1 + (1 if vn == pn else 0), col] = self.color # smoothen graph by connecting prev and current value
+           self.prev[i] = vn
+
+    def update(self, roller, samples, cols): # samples: traces x samples, cols: buffer column for each sample
+        traces, n = samples.shape
+        if self.prev is None or len(self.prev) != traces:
+           self.prev = np.full(traces, -1)
+
+        valid = (samples >= self.minv) & (samples <= self.maxv) # out of range samples are skipped
+        vn = self.num_to_range(np.where(valid, samples, self.minv), self.minv, self.maxv, self.gridheight, 0) + self.gridmargin
+
+        # previous pixel row for every sample: the last valid sample before it
+        lastpos = np.maximum.accumulate(np.where(valid, np.arange(n), -1), axis = 1)
+        prevpos = np.concatenate((np.full((traces, 1), -1), lastpos[:, :-1]), axis = 1)
+        pn = np.where(prevpos >= 0, np.take_along_axis(vn, np.maximum(prevpos, 0), axis = 1), self.prev[:, None])
+
+        # smoothen graph by connecting prev and current value
+        lo = np.minimum(vn, pn)
+        self.draw(roller, cols, lo, np.maximum(vn, pn) + 1 + (vn == pn), valid & (pn >= 0))
+
+        self.prev = np.where(lastpos[:, -1] >= 0, np.take_along_axis(vn, np.maximum(lastpos[:, -1:], 0), axis = 1)[:, 0], self.prev)
+
+    def draw(self, roller, cols, lo, hi, ok): # one vertical span [lo, hi) per trace and column, drawn in one pass
+        lo = np.clip(lo, 0, roller.shape[0])
+        lengths = np.where(ok, np.clip(hi, 0, roller.shape[0]) - lo, 0).ravel()
+        lengths[lengths < 0] = 0
+        # pixel coordinates of all spans - memory follows the painted pixels, not the window size
+        ends = np.cumsum(lengths)
+        rr = np.arange(ends[-1] if len(ends) > 0 else 0) - np.repeat(ends - lengths - lo.ravel(), lengths)
+        cc = np.repeat(np.broadcast_to(cols, lo.shape).ravel(), lengths)
+        roller[rr, cc] = self.color
+
+    def spans(self, mn, mx, prev): # spans covering min..max, connected to the previous column's last value
+        lo = np.where(prev >= 0, np.minimum(mn, prev), mn)
+        hi = np.where(prev >= 0, np.maximum(mx, prev), mx)
+        return lo, hi + 1 + (lo == hi), mx >= 0
+
+    def zdraw(self, roller, cols, mn, mx, last): # draw pyramid entries ( traces x entries ) as min/max spans, clipped to the scale
+        def row(v):
+            return self.num_to_range(np.clip(v, self.minv, self.maxv), self.minv, self.maxv, self.gridheight, 0) + self.gridmargin
+        ok = (mx >= self.minv) & (mn <= self.maxv)
+        top = np.where(ok, row(mx), -1)
+        bottom = np.where(ok, row(mn), -1)
+        last = np.where(ok, row(last), -1)
+        carry = np.maximum.accumulate(np.where(ok, np.arange(last.shape[1]), -1), axis = 1) # connect across empty entries
+        last = np.where(carry >= 0, np.take_along_axis(last, np.maximum(carry, 0), axis = 1), -1)
+        prev = np.concatenate((np.full((last.shape[0], 1), -1), last[:, :-1]), axis = 1)
+        self.draw(roller, cols, *self.spans(top, bottom, prev))
+
+    def aggregate(self, samples, tcols): # time mode: reduce samples to min/max/last per column. returns spans for completed columns
+        traces, n = samples.shape
+        if self.prev is None or len(self.prev) != traces:
+           self.prev = np.full(traces, -1)
+           self.pcol = None
+
+        order = np.argsort(tcols, kind = 'stable')
+        samples, tcols = samples[:, order], tcols[order]
+        valid = (samples >= self.minv) & (samples <= self.maxv)
+        vn = self.num_to_range(np.where(valid, samples, self.minv), self.minv, self.maxv, self.gridheight, 0) + self.gridmargin
+
+        starts = np.flatnonzero(np.concatenate(([True], tcols[1:] != tcols[:-1])))
+        ends = np.concatenate((starts[1:], [n])) - 1
+        gcols = tcols[starts]
+        mn = np.minimum.reduceat(np.where(valid, vn, np.iinfo(vn.dtype).max), starts, axis = 1)
+        mx = np.maximum.reduceat(np.where(valid, vn, -1), starts, axis = 1)
+        mn[mx < 0] = -1
+        lastpos = np.maximum.accumulate(np.where(valid, np.arange(n), -1), axis = 1)[:, ends]
+        last = np.where(lastpos >= 0, np.take_along_axis(vn, np.maximum(lastpos, 0), axis = 1), -1)
+
+        if self.pcol is not None: # merge with, or complete the pending column
+            if gcols[0] == self.pcol:
+                both = (mx[:, 0] >= 0) & (self.pmax >= 0)
+                mn[:, 0] = np.where(both, np.minimum(mn[:, 0], self.pmin), np.maximum(mn[:, 0], self.pmin))
+                mx[:, 0] = np.maximum(mx[:, 0], self.pmax)
+                last[:, 0] = np.where(last[:, 0] >= 0, last[:, 0], self.plast)
+            else:
+                gcols = np.concatenate(([self.pcol], gcols))
+                mn = np.concatenate((self.pmin[:, None], mn), axis = 1)
+                mx = np.concatenate((self.pmax[:, None], mx), axis = 1)
+                last = np.concatenate((self.plast[:, None], last), axis = 1)
+
+        # columns without valid samples carry the last value of the column before
+        carry = np.maximum.accumulate(np.where(last >= 0, np.arange(last.shape[1]), -1), axis = 1)
+        last = np.where(carry >= 0, np.take_along_axis(last, np.maximum(carry, 0), axis = 1), -1)
+        prev = np.concatenate((self.prev[:, None], last[:, :-1]), axis = 1)
+
+        self.pcol, self.pmin, self.pmax, self.plast, self.prev = gcols[-1], mn[:, -1], mx[:, -1], last[:, -1], prev[:, -1]
+        return (gcols[:-1],) + self.spans(mn[:, :-1], mx[:, :-1], prev[:, :-1])
+
+    def pending(self): # time mode: spans for the column still collecting samples
+        return (np.array([self.pcol]),) + self.spans(self.pmin[:, None], self.pmax[:, None], self.prev[:, None])
 
 ############################################################################
 # Data panel ( = scale + graph + right )
 ############################################################################
 class Panel(object):
 
-    def __init__(self, name, canvas, ldef, rdef, box, scalewidth=36):
+    def __init__(self, name, canvas, ldef, rdef, box, scalewidth=36, timespan=0, prev=None, autoscale=False): # prev: panel replaced by this one
         self.box = box
         self.canvas = canvas
         self.leftscalewidth = scalewidth # if bool(ldef) is not False else 0 # updated - let's always have left scale
         self.rightscalewidth = scalewidth # if bool(rdef) is not False else 0 # updated - let's always have right scale
-        self.leftscale = Scale(ldef, self.leftscalebox(box), pos = 0)
-        self.rightscale = Scale(rdef, self.rightscalebox(box), pos = 1)
-        self.graph = Graph(name, self.leftscale, self.rightscale, self.graphbox(box))
+        self.leftscale = Scale(ldef, self.leftscalebox(box), pos = 0, auto = autoscale)
+        self.rightscale = Scale(rdef, self.rightscalebox(box), pos = 1, auto = autoscale)
+        self.graph = Graph(name, self.leftscale, self.rightscale, self.graphbox(box), timespan = timespan,
+            prev = prev.graph if prev is not None else None)
 
     def leftscalebox(self, box):
         return util.Box(self.canvas, None, box.sbxoffs(), box.sbyoffs(), self.leftscalewidth, box.sbheight(), topbotmargin = 1, fill = 240) # 200)
@@ -276,19 +839,26 @@ class Panel(object):
             box.sbwidth() - (self.leftscale.box.width+self.rightscale.box.width), box.sbheight(),
             topbotmargin = 1)
 
-    def update(self, lmsg, rmsg, dmsg): 
-        self.graph.update(lmsg, rmsg, dmsg)
+    def move(self, xoffs, yoffs): # same size, new place. the scales and the graph keep their windows, the next flush paints them
+        dx, dy = xoffs - self.box.xoffs, yoffs - self.box.yoffs
+        for box in (self.box, self.leftscale.box, self.rightscale.box, self.graph.box):
+            box.move(box.xoffs + dx, box.yoffs + dy)
+
+    def update(self, lmsg, rmsg, dmsg, t = None): 
+        self.graph.update(lmsg, rmsg, dmsg, t)
 
     def flush(self): 
-        self.box.flush()
-        self.graph.flush()
+        damage = self.box.flush()
+        return ([damage] if damage is not None else []) + self.graph.flush()
 
 ############################################################################
 # Manage Set of graphs
 ############################################################################
+MINROWHEIGHT = 80 # pixels - smaller panels have no room for two scale labels
+
 class Panels(object):
 
-    def __init__(self, canvas, box, cols = 2, minrowheight = 64):
+    def __init__(self, canvas, box, cols = 2, minrowheight = MINROWHEIGHT, timespan = 0, prev = None, autoscale = False): # prev: panels replaced by these ( relayout )
         self.box    = box
         self.canvas = canvas
         self.panels = {}
@@ -298,8 +868,17 @@ class Panels(object):
         self.rows  = 0
         self.blocked = {}
         self.minrowheight = minrowheight
+        self.timespan = timespan # seconds per pixel column, 0: one column per message
+        self.zoom = 0 # history pyramid level shown by all graphs, -1: whole session
+        self.autoscale = autoscale # autoscale graph scales without range
+
+        if prev is not None and self.cols > 0: # keep graphs and their history
+            self.ldefs, self.rdefs, self.blocked, self.zoom = prev.ldefs, prev.rdefs, prev.blocked, prev.zoom
+            if len(prev.panels) > 0:
+                self.panels = prev.panels
+                self.redraw(None)
 
-    def update(self, name, message):
+    def update(self, name, message, t = None): # t: message (receive) time
 
         if self.cols == 0:
             return
@@ -322,19 +901,24 @@ class Panels(object):
                 self.redraw(name)
 
         if name in self.panels and not name in self.blocked:
-            self.panels[name].update(lmsg, rmsg, dmsg)
+            t0 = time.perf_counter()
+            self.panels[name].update(lmsg, rmsg, dmsg, t)
+            metrics.timed('streamview_draw_seconds', t0, panel = name)
 
-    def redraw(self, name):
+    def redraw(self, name): # name: new panel, None for relayout only. panels that keep their size are moved, the others rebuilt
         self.box.wipe()
-        panelnames  = sorted(list(self.panels.keys()) + ([name]))
+        panelnames  = sorted(list(self.panels.keys()) + ([name] if name is not None else []))
+        oldpanels   = self.panels
         self.panels = {}
         self.rows = math.ceil(len(panelnames) / self.cols)
-        while True:
-            panelheight = math.floor(self.box.sbheight() / self.rows)
-            if panelheight < self.minrowheight and self.rows > 0:
-                self.rows -= 1
-                continue
-            break
+        if self.rows == 0:
+            return
+        while self.rows > 1 and math.floor(self.box.sbheight() / self.rows) < self.minrowheight:
+            self.rows -= 1
+        panelheight = math.floor(self.box.sbheight() / self.rows)
+        for name in panelnames[self.rows * self.cols:]: # no room left after a relayout
+            print("Cannot fit graph - skipping: {}".format(name), file=sys.stderr)
+            self.blocked[name] = True
         for row in range(0, self.rows):
             rowbox = util.Box(None, None, self.box.sbxoffs(), self.box.sbyoffs() + row * panelheight, self.box.sbwidth(), panelheight,
             topbotmargin = 0, sidemargin = 0)
@@ -344,12 +928,29 @@ class Panels(object):
                 idx = row * self.cols + col % self.cols
                 if idx < len(panelnames):
                    name = panelnames[idx]
+                   old = oldpanels.get(name)
+                   if old is not None and (old.box.width, old.box.height) == (w, h):
+                       old.move(rowbox.sbxoffs() + col * w, rowbox.sbyoffs())
+                       self.panels[name] = old
+                       continue
                    box = util.Box(self.canvas, name, rowbox.sbxoffs() + col * w, rowbox.sbyoffs(), w, h, border = True)
-                   self.panels[name] = Panel(name, self.canvas, self.ldefs[name], self.rdefs[name], box)
+                   self.panels[name] = Panel(name, self.canvas, self.ldefs[name], self.rdefs[name], box, timespan = self.timespan,
+                       prev = oldpanels.get(name), autoscale = self.autoscale)
+                   self.panels[name].graph.setzoom(self.zoom)
+
+    def cyclezoom(self, step = 1): # next ( step 1 ) or previous ( step -1 ) window: every column, 1:4 .. 1:4096, whole session
+        zooms = list(range(History.LEVELS + 1)) + [-1]
+        self.zoom = zooms[(zooms.index(self.zoom) + step) % len(zooms)]
+        for panel in self.panels.values():
+            panel.graph.setzoom(self.zoom)
 
     def count(self): 
         return len(self.panels)
 
-    def flush(self): 
+    def flush(self): # returns list of damaged areas
+        damage = []
         for name in self.panels.keys():
-           self.panels[name].flush()
+           t0 = time.perf_counter()
+           damage += self.panels[name].flush()
+           metrics.timed('streamview_draw_seconds', t0, panel = name)
+        return damage
@@ -0,0 +1,180 @@
+import os
+import zmq
+import time
+import bisect
+import threading
+
+############################################################################
+# Metrics - counters and latency histograms for the viewer pipeline, in
+# prometheus text exposition format. one registry per process, updated from
+# the render, receive, video worker and video writer threads
+############################################################################
+BUCKETS = [0.00005 * 2 ** i for i in range(16)] # seconds: 50us .. 1.6s, doubling
+LATENCY_BUCKETS = [0.0001 * 2 ** (i / 4) for i in range(68)] # seconds: 0.1ms .. 12s, four per doubling ( ~19% resolution, hdr style log buckets )
+
+BOUNDS = { # histograms with other than the default buckets
+    'streamview_latency_receive_seconds' : LATENCY_BUCKETS,
+    'streamview_latency_composite_seconds' : LATENCY_BUCKETS,
+    'streamview_latency_display_seconds' : LATENCY_BUCKETS,
+    'streamview_latency_encode_seconds' : LATENCY_BUCKETS,
+}
+
+HELP = {
+    'streamview_receive_seconds' : 'socket receive time per message',
+    'streamview_unpickle_seconds' : 'unpickle / frame decode time per message',
+    'streamview_convert_seconds' : 'video color conversion time per displayed image',
+    'streamview_resize_seconds' : 'video scaling time per displayed image',
+    'streamview_draw_seconds' : 'graph panel drawing time per update and flush',
+    'streamview_flush_seconds' : 'time to composite one frame',
+    'streamview_encode_seconds' : 'video file encoding time per frame',
+    'streamview_imshow_seconds' : 'display time per frame',
+    'streamview_messages_total' : 'messages received per port',
+    'streamview_graph_messages_total' : 'graph messages per stream',
+    'streamview_video_frames_total' : 'video images received per stream',
+    'streamview_video_dropped_total' : 'video images per stream replaced by a newer one before display',
+    'streamview_frames_total' : 'rendered frames',
+    'streamview_output_dropped_total' : 'frames the video file writer could not keep up with',
+    'streamview_latency_receive_seconds' : 'publisher send to receive, per stream ( stamped messages, same host clock )',
+    'streamview_latency_composite_seconds' : 'receive to composited into the canvas, per stream',
+    'streamview_latency_display_seconds' : 'composited to displayed',
+    'streamview_latency_encode_seconds' : 'composited to encoded into the video file',
+}
+
+class Histogram(object):
+
+    def __init__(self, bounds = BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # last: +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}   # (name, labels) : value
+        self.histograms = {} # (name, labels) : Histogram
+
+    def inc(self, name, n = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = Histogram(BOUNDS.get(name, BUCKETS))
+            h.observe(value)
+
+    def value(self, name, **labels): # counter value, summed over all label sets not given
+        with self.lock:
+            return sum(v for (n, l), v in self.counters.items() if n == name and all(item in l for item in labels.items()))
+
+    def counts(self, name): # bucket counts of a histogram, summed over all label sets. None if nothing observed yet
+        with self.lock:
+            hs = [h for (n, l), h in self.histograms.items() if n == name]
+            return [sum(c) for c in zip(*[h.counts for h in hs])] if len(hs) > 0 else None
+
+    def text(self): # prometheus text exposition format
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (h.bounds, list(h.counts), h.sum, h.count)) for key, h in self.histograms.items())
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines += ["# HELP {} {}".format(name, HELP.get(name, name)), "# TYPE {} counter".format(name)]
+            lines.append("{}{} {}".format(name, labelstr(labels), value))
+        for (name, labels), (bounds, counts, total, count) in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines += ["# HELP {} {}".format(name, HELP.get(name, name)), "# TYPE {} histogram".format(name)]
+            cumulative = 0
+            for bound, n in zip(bounds + [float('inf')], counts):
+                cumulative += n
+                lines.append("{}_bucket{} {}".format(name, labelstr(labels + (('le', "{:g}".format(bound) if bound != float('inf') else "+Inf"),)), cumulative))
+            lines.append("{}_sum{} {:.6f}".format(name, labelstr(labels), total))
+            lines.append("{}_count{} {}".format(name, labelstr(labels), count))
+        return "\n".join(lines) + "\n"
+
+def labelstr(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + "}"
+
+def quantile(name, q, counts): # upper bucket bound below which a fraction q of the counts fall. counts: e.g. a difference of Metrics.counts
+    bounds = BOUNDS.get(name, BUCKETS)
+    total = sum(counts)
+    if total == 0:
+        return None
+    cumulative = 0
+    for bound, n in zip(bounds, counts):
+        cumulative += n
+        if cumulative >= q * total:
+            return bound
+    return bounds[-1]
+
+registry = Metrics()
+enabled = False # off: inc, observe and timed do nothing - they are on the per message path
+
+def enable():
+    global enabled
+    enabled = True
+
+def inc(name, n = 1, **labels):
+    if enabled:
+        registry.inc(name, n, **labels)
+
+def observe(name, value, **labels):
+    if enabled:
+        registry.observe(name, value, **labels)
+
+def timed(name, t0, **labels): # observe the time since t0 ( perf_counter ). returns now, the start of the next stage
+    if not enabled:
+        return t0
+    t = time.perf_counter()
+    registry.observe(name, t - t0, **labels)
+    return t
+
+############################################################################
+# Export - every interval seconds, write the metrics to a text file ( e.g.
+# for the node exporter textfile collector ) and / or publish them as a
+# string on a local zmq PUB socket
+############################################################################
+class Export(object):
+
+    def __init__(self, path = None, port = None, interval = 1.0, context = None):
+        self.path = path
+        self.interval = interval
+        self.last = 0
+        self.sock = None
+        if port is not None:
+            self.sock = (context or zmq.Context.instance()).socket(zmq.PUB)
+            self.sock.bind("tcp://127.0.0.1:{}".format(port))
+
+    def poll(self): # export if due
+        now = time.time()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        text = registry.text()
+        if self.path is not None:
+            with open(self.path + ".tmp", "w") as f: # replace, so readers never see a partial file
+                f.write(text)
+            os.replace(self.path + ".tmp", self.path)
+        if self.sock is not None:
+            self.sock.send_string(text)
+
+    def close(self):
+        self.last = 0
+        self.poll()
+        if self.sock is not None:
+            self.sock.close()
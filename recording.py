@@ -0,0 +1,278 @@
+import os
+import json
+import math
+import time
+import mmap
+import zlib
+import queue
+import pickle
+import struct
+import itertools
+import threading
+import collections
+import numpy as np
+
+############################################################################
+# Recording - a directory with append-only files:
+#   data         chunks: a header, then for video frames a json header and
+#                the raw image buffer, for graph messages a pickled list of
+#                (port, time, message) records. optionally zlib compressed
+#   index        fixed size entry per chunk: time, offset, size, stream, port, kind
+#   seconds      per second of the recording: index entry of its first chunk.
+#                seeking to any time is two fixed size reads
+#   streams.json start time and stream names ( index stream ids )
+# files are only appended to, index entries after their chunk - a crash loses
+# the chunks being written only
+############################################################################
+CHUNK = struct.Struct("<4sBBHdIII") # magic, kind, codec, port, time, stream, json header size, payload size
+MAGIC = b"SVR1"
+FRAME, RECORDS = 0, 1 # chunk kinds
+RAW, ZLIB = 0, 1      # chunk codecs
+ALL = 0xFFFFFFFF      # stream id of record chunks: any graph stream
+
+INDEX = np.dtype([('t', '<f8'), ('offset', '<u8'), ('size', '<u4'), ('stream', '<u4'), ('port', '<u2'), ('kind', 'u1')]) # packed, 27 bytes
+SECONDS = np.dtype('<u8')
+
+BATCHSECONDS = 1.0 # graph records are batched up to this long, until a video frame is written or the second changes
+BATCHRECORDS = 1024
+
+def isvideo(message): # video messages: name : image
+    return isinstance(message, dict) and len(message) > 0 and all(isinstance(v, np.ndarray) for v in message.values())
+
+class Recorder(object):
+
+    def __init__(self, path, level = 0, queuesize = 1024): # level: zlib compression level, 0: none
+        os.makedirs(path, exist_ok = True)
+        if os.path.exists(os.path.join(path, "data")):
+            raise FileExistsError("recording exists: {}".format(path))
+        self.path = path
+        self.level = level
+        self.data = open(os.path.join(path, "data"), "ab")
+        self.index = open(os.path.join(path, "index"), "ab")
+        self.seconds = open(os.path.join(path, "seconds"), "ab")
+        self.start = None
+        self.streams = {} # name : id
+        self.chunks = 0   # index entries written
+        self.nseconds = 0 # seconds entries written
+        self.records = [] # graph records not written yet
+        self.queue = queue.Queue(maxsize = queuesize) # full: receivers wait - nothing is dropped
+        self.thread = threading.Thread(target = self.run, daemon = True, name = "recorder")
+        self.thread.start()
+
+    def write(self, port, t, message, meta = None): # any thread. meta: frame headers by stream name, if any
+        self.queue.put((port, t, message, meta))
+
+    def run(self): # writer thread
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            port, t, message, meta = item
+            if self.start is None:
+                self.start = math.floor(t)
+                self.savestreams()
+            if isvideo(message):
+                self.flushrecords() # keeps the file in time order
+                for name, img in message.items():
+                    self.frame(port, t, name, img, (meta or {}).get(name, {}))
+            else:
+                if len(self.records) > 0 and math.floor(t - self.start) != math.floor(self.records[0][1] - self.start): # chunks stay within a second, so the seconds table reaches every record
+                    self.flushrecords()
+                self.records.append((port, t, message))
+                if len(self.records) >= BATCHRECORDS or t - self.records[0][1] >= BATCHSECONDS:
+                    self.flushrecords()
+            if self.queue.empty():
+                self.data.flush()
+                self.index.flush()
+                self.seconds.flush()
+        self.flushrecords()
+        for f in (self.data, self.index, self.seconds):
+            f.close()
+
+    def frame(self, port, t, name, img, meta):
+        if name not in self.streams:
+            self.streams[name] = len(self.streams)
+            self.savestreams()
+        img = np.ascontiguousarray(img)
+        header = json.dumps({"name" : name, "shape" : img.shape, "dtype" : img.dtype.str, "color" : meta.get("color"),
+            "sent" : meta.get("sent")}).encode()
+        payload = memoryview(img).cast('B')
+        self.chunk(FRAME, port, t, self.streams[name], header, payload)
+
+    def flushrecords(self):
+        if len(self.records) > 0:
+            port, t, _ = self.records[0]
+            self.chunk(RECORDS, port, t, ALL, b"", pickle.dumps(self.records, protocol = pickle.HIGHEST_PROTOCOL))
+            self.records = []
+
+    def chunk(self, kind, port, t, stream, header, payload):
+        codec = RAW
+        if self.level > 0:
+            payload, codec = zlib.compress(payload, self.level), ZLIB
+        offset = self.data.tell()
+        self.data.write(CHUNK.pack(MAGIC, kind, codec, port, t, stream, len(header), len(payload)))
+        self.data.write(header)
+        self.data.write(payload)
+        size = CHUNK.size + len(header) + len(payload)
+        while self.nseconds <= t - self.start: # seconds up to this chunk start here
+            self.seconds.write(struct.pack("<Q", self.chunks))
+            self.nseconds += 1
+        self.index.write(np.array([(t, offset, size, stream, port, kind)], dtype = INDEX).tobytes())
+        self.chunks += 1
+
+    def savestreams(self): # replaced, never partially written
+        tmp = os.path.join(self.path, "streams.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"version" : 1, "start" : self.start, "streams" : sorted(self.streams, key = self.streams.get)}, f)
+        os.replace(tmp, os.path.join(self.path, "streams.json"))
+
+    def close(self): # write what is queued, then close the files
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+############################################################################
+# Recording reader - files are memory mapped, images are read only views on
+# the data file ( no copy ) unless compressed
+############################################################################
+class Recording(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "streams.json")) as f:
+            meta = json.load(f)
+        self.start = meta["start"]
+        self.streams = meta["streams"]
+        self.data = self.map("data")
+        index = self.map("index")
+        self.index = np.frombuffer(index, dtype = INDEX, count = len(index) // INDEX.itemsize)
+        n = len(self.index)
+        while n > 0 and int(self.index[n - 1]['offset']) + int(self.index[n - 1]['size']) > len(self.data): # a crash may leave index entries without data
+            n -= 1
+        self.index = self.index[:n]
+        seconds = self.map("seconds")
+        self.seconds = np.frombuffer(seconds, dtype = SECONDS, count = len(seconds) // SECONDS.itemsize)
+
+    def map(self, name):
+        with open(os.path.join(self.path, name), "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size > 0 else b""
+
+    def __len__(self):
+        return len(self.index)
+
+    def duration(self): # time of the last message - index entries have the time of the first record in a chunk
+        return float(max(t for _, t, _, _ in self.chunk(len(self.index) - 1)) - self.start) if len(self.index) > 0 else 0
+
+    def find(self, t): # index of the first chunk at or after time t ( seconds since start ). O(1)
+        k = max(0, int(t))
+        if k >= len(self.seconds):
+            return len(self.index)
+        return min(int(self.seconds[k]), len(self.index))
+
+    def chunk(self, i): # list of ( port, time, message, meta )
+        entry = self.index[i]
+        offset = int(entry['offset'])
+        magic, kind, codec, port, t, stream, hlen, plen = CHUNK.unpack_from(self.data, offset)
+        offset += CHUNK.size
+        if kind == RECORDS:
+            payload = self.data[offset + hlen : offset + hlen + plen]
+            return [(p, t, message, {}) for p, t, message in pickle.loads(zlib.decompress(payload) if codec == ZLIB else payload)]
+        header = json.loads(bytes(self.data[offset : offset + hlen]))
+        offset += hlen
+        dtype = np.dtype(header["dtype"])
+        if codec == ZLIB:
+            img = np.frombuffer(zlib.decompress(self.data[offset : offset + plen]), dtype = dtype)
+        else:
+            img = np.frombuffer(self.data, dtype = dtype, count = plen // dtype.itemsize, offset = offset)
+        return [(port, t, {header["name"] : img.reshape(header["shape"])}, {header["name"] : header})]
+
+    def messages(self, i0 = 0): # all messages from chunk i0 on, in recording order
+        for i in range(i0, len(self.index)):
+            for message in self.chunk(i):
+                yield message
+
+############################################################################
+# Replay - a recording as message sources with the util.iMsg read interface,
+# one for video and one for graph messages. messages are due when the replay
+# clock reaches their receive time. speed: 1 realtime, N: N times faster,
+# 0: as fast as possible - the clock is virtual and only moves when the
+# viewer has handled everything due ( see sleep ). also reads the pickle
+# files of older streamview versions ( -po ), without seeking
+############################################################################
+class Replay(object):
+
+    def __init__(self, path, speed = 1.0, start = 0, end = None): # start, end: seconds into the recording
+        self.speed = speed
+        if os.path.isdir(path):
+            self.recording = Recording(path)
+            t0 = self.recording.start + start
+            messages = (m for m in self.recording.messages(self.recording.find(start)) if m[1] >= t0) # find has whole second resolution
+        else:
+            self.recording = None
+            first = next(legacy(path), (None, 0))[1]
+            messages = (m for m in legacy(path) if m[1] >= first + start)
+            t0 = first + start
+        self.end = t0 - start + end if end is not None else None
+        self.messages = messages if end is None else itertools.takewhile(lambda m: m[1] < self.end, messages)
+        self.next = next(self.messages, None) # lookahead: ( port, time, message, meta )
+        self.t0 = t0
+        self.now = self.t0  # virtual clock, speed 0
+        self.wall0 = None
+        self.queues = {'video' : collections.deque(), 'graph' : collections.deque()}
+
+    def source(self, kind): # 'video' or 'graph'
+        return ReplaySource(self, kind)
+
+    def clock(self): # replay time, in recorded time.time() seconds
+        if self.speed > 0:
+            if self.wall0 is None:
+                self.wall0 = time.time()
+            return self.t0 + (time.time() - self.wall0) * self.speed
+        return self.now
+
+    def sleep(self, wait): # wait: replay seconds until the next frame. returns wall clock seconds to wait
+        if self.speed > 0:
+            return wait / self.speed
+        self.now += wait + 1e-6 # just past the frame deadline - the frame is due, messages up to it are read first
+        return 0
+
+    def take(self, kind): # next due message of this kind, or None
+        now = self.clock()
+        while self.next is not None and self.next[1] <= now:
+            self.queues['video' if isvideo(self.next[2]) else 'graph'].append(self.next)
+            self.next = next(self.messages, None)
+        queue = self.queues[kind]
+        return queue.popleft() if len(queue) > 0 else None
+
+    def finished(self): # with an end: frames up to the end are rendered, messages or not
+        return self.next is None and all(len(q) == 0 for q in self.queues.values()) and (self.end is None or self.clock() >= self.end)
+
+class ReplaySource(object):
+
+    def __init__(self, replay, kind):
+        self.replay = replay
+        self.kind = kind
+        self.sock = None # nothing to poll - read whenever the viewer wakes up
+        self.port = None
+        self.time = None # recorded receive time of the last message read
+        self.meta = {}
+        self.sent = None # send stamps of another session's clock - not comparable
+        self.received = None
+
+    def read(self):
+        message = self.replay.take(self.kind)
+        if message is None:
+            return None
+        self.port, self.time, message, self.meta = message
+        self.received = time.monotonic()
+        return message
+
+def legacy(path): # ( port, time, message, meta ) from a pickle file of older versions
+    with open(path, "rb") as f:
+        while True:
+            try:
+                port, t, message = pickle.load(f)
+            except EOFError:
+                return
+            yield (port, t, message, {})
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import glob
+import math
+import shutil
+import argparse
+import subprocess
+import multiprocessing
+
+import sink
+import recording
+import streamview
+
+############################################################################
+# Offline render - a recording is split into time segments, rendered by a
+# pool of processes, each with its own Streamview replaying as fast as
+# possible. a worker starts warmup seconds before its segment, so graph
+# windows and scales are filled when its first frame is written. segments
+# start on the same frame grid, so they join without gaps or doubles
+############################################################################
+class Segment(object): # sink: passes the frames of one segment to the video file
+
+    def __init__(self, viewer, out, first, last): # first, last: frame numbers, since the worker's replay start
+        self.viewer = viewer
+        self.out = out
+        self.first = first
+        self.last = last
+
+    def write(self, canvas, damage):
+        if self.first <= self.viewer.lastsnapped < self.last:
+            self.out.write(canvas, damage)
+
+    def close(self):
+        self.out.close()
+
+class Batch(object): # keyboard of a worker: no keys, runs until its replay ends. util.Control would catch the SIGTERM the pool stops workers with
+
+    key = None
+
+    def quit(self):
+        return False
+
+    def fileno(self):
+        return None
+
+def render(job): # worker: render one segment into its own directory. end None: to the end of the recording
+    idx, path, start, end, warmup, outdir, options = job
+    sys.stdout = open(os.devnull, "w") # status lines of several workers would mix
+    wstart = max(0, start - warmup)
+    replay = recording.Replay(path, speed = 0, start = wstart, end = end)
+    viewer = streamview.Streamview(Batch(),
+        introtxt     = "",
+        image_msg    = replay.source('video'),
+        graph_msg    = replay.source('graph'),
+        savevideo    = False,
+        headless     = True,
+        replay       = replay,
+        **options)
+    fps = options['fps']
+    segmentpath = os.path.join(outdir, "{:05d}".format(idx))
+    out = sink.VideoFileSink(segmentpath, fps, (viewer.canvas.shape[1], viewer.canvas.shape[0]), policy = 'block')
+    viewer.sinks.append(Segment(viewer, out, round((start - wstart) * fps), round((end - wstart) * fps) if end is not None else math.inf))
+    if wstart > 0: # frame 0 is a frame of the recording here - a viewer starts with frame 1, like the first segment
+        viewer.lastsnapped = -1
+    viewer.run()
+    return glob.glob(os.path.join(segmentpath, "*.mp4"))[0]
+
+def concat(segments, output, listfile): # lossless: the ffmpeg concat demuxer copies the streams
+    with open(listfile, "w") as f:
+        for segment in segments:
+            f.write("file '{}'\n".format(os.path.abspath(segment)))
+    if shutil.which("ffmpeg") is None:
+        return False
+    subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", listfile, "-c", "copy", output], check = True)
+    return True
+
+############################################################################
+# main
+############################################################################
+if __name__ == "__main__":
+
+   parser = argparse.ArgumentParser(description='Render a recording to video, in parallel')
+   parser.add_argument('recording', help="recording directory ( streamview -recordpath )")
+   parser.add_argument('-o', '--output', help="output video file", default='FILES/render.mp4')
+   parser.add_argument('-j', '--jobs', help='number of render processes', default=os.cpu_count() or 1, type=int)
+   parser.add_argument('-sl', '--segmentlength', help='seconds per segment (0: recording length / jobs)', default=0, type=int)
+   parser.add_argument('-wu', '--warmup', help='seconds replayed before a segment starts, to fill graph windows', default=30, type=int)
+   parser.add_argument('-width', help="viewer window pixel width", type=int, default=800)
+   parser.add_argument('-height', help="viewer window pixel height", default=680, type=int)
+   parser.add_argument('-fps', help="video output frame rate", type=int, default=25)
+   parser.add_argument('-videocolormodel', help="video input color subpixel order", default='rgb', choices=['bgr','rgb'])
+   parser.add_argument('-videoscalingfactor', help="input video scaling factor", type=float, default=1)
+   parser.add_argument('-gc', '--graphcols', help='number of graph columns', default=1, type=int, choices=range(0, 6))
+   parser.add_argument('-vc', '--videocols', help='number of video columns', default=2, type=int, choices=range(0, 6))
+   parser.add_argument('-gt', '--graphtimespan', help='seconds per graph pixel column (0: one column per message)', default=0, type=float)
+   parser.add_argument('-ga', '--graphautoscale', help='autoscale graph y-axes that have no min/max in their scale definition', action='store_true', default=False)
+
+   args = parser.parse_args()
+
+   if not os.path.isdir(args.recording):
+       print("not a recording directory: {}".format(args.recording), file=sys.stderr)
+       exit(1)
+
+   frames = round(recording.Recording(args.recording).duration() * args.fps) # frame of the last message
+   length = args.segmentlength * args.fps if args.segmentlength > 0 else max(1, math.ceil((frames + 1) / args.jobs)) # frames per segment
+   outdir = os.path.splitext(args.output)[0] + "-segments"
+   if os.path.exists(outdir):
+       print("segment directory exists: {}".format(outdir), file=sys.stderr)
+       exit(1)
+
+   options = dict(canvas_w = args.width, canvas_h = args.height, fps = args.fps, videopath = outdir, videocolormodel = args.videocolormodel,
+       videoscalingfactor = args.videoscalingfactor, graphcols = args.graphcols, videocols = args.videocols, videothreads = 0,
+       graphtimespan = args.graphtimespan, graphautoscale = args.graphautoscale, videoworkers = 0) # one process per core already
+   jobs = [(idx, args.recording, start / args.fps, (start + length) / args.fps if start + length <= frames else None, args.warmup, outdir, options)
+       for idx, start in enumerate(range(0, frames + 1, length))] # the last segment ends with the replay, like a single one
+
+   print("Rendering {:.1f} seconds in {} segments on {} processes".format(frames / args.fps, len(jobs), args.jobs))
+   with multiprocessing.get_context("spawn").Pool(args.jobs) as pool: # fresh processes: forked opencv and thread state can deadlock
+       segments = pool.map(render, jobs)
+
+   listfile = os.path.join(outdir, "segments.txt")
+   if concat(segments, args.output, listfile):
+       shutil.rmtree(outdir)
+       print("Video: {}".format(args.output))
+   else:
+       print("ffmpeg not found - segments are in {}, join them with:\n  ffmpeg -f concat -safe 0 -i {} -c copy {}".format(outdir, listfile, args.output))
@@ -0,0 +1,156 @@
+import os
+import cv2
+import time
+import queue
+import threading
+import numpy as np
+import util
+import metrics
+
+############################################################################
+# Frame sinks - every rendered canvas is handed to each sink. the display
+# window is not a sink, headless mode just leaves it out
+############################################################################
+
+############################################################################
+# Video file - fixed frame rate, frames without changes repeat the canvas.
+# encoding runs on a writer thread, frames are handed over in a bounded set
+# of preallocated buffers. when the writer falls behind, policy decides:
+# 'repeat' drops the frame and has the writer repeat the previous one ( the
+# file keeps its timeline ), 'drop' just drops it, 'block' waits for the
+# writer. segments: a new file every segment seconds ( of video ) or
+# segmentmb megabytes. a crash loses the open segment only
+############################################################################
+REPEAT = "repeat" # frame queue marker: write the previous frame again
+STOP = "stop"     # frame queue marker: close the file and end the writer
+
+class VideoFileSink(object):
+
+    def __init__(self, videopath, fps, size, queuesize = 8, policy = 'repeat', segment = 0, segmentmb = 0): # size: canvas width, height
+        os.makedirs(videopath, exist_ok = True)
+        self.videopath = videopath
+        self.fps = fps
+        self.size = size
+        self.policy = policy
+        self.segment = segment
+        self.segmentbytes = segmentmb * 1024 * 1024
+        self.free = queue.Queue() # frame buffers the render thread can fill, one more than queued: the writer keeps the last frame
+        for i in range(queuesize + 1):
+            self.free.put(np.empty((size[1], size[0], 3), dtype = np.uint8))
+        self.frames = queue.Queue(maxsize = 4 * queuesize) # (buffer or marker, composite time), oldest first
+        self.dropped = 0
+        self.written = False # a frame was queued - repeats need a previous frame
+        self.handle = None
+        self.segments = 0
+        self.thread = threading.Thread(target = self.run, daemon = True, name = "videowriter")
+        self.thread.start()
+
+    def filename(self):
+        suffix = "-{:03d}".format(self.segments) if self.segment > 0 or self.segmentbytes > 0 else ""
+        return "{}/video-{}-{}{}.mp4".format(self.videopath, time.strftime("%Y%m%d"), time.strftime("%H%M"), suffix)
+
+    def write(self, canvas, damage): # render thread
+        if len(damage) == 0 and self.written: # unchanged - no copy needed
+            self.put(REPEAT)
+            return
+        if self.policy == 'block':
+            buf = self.free.get()
+        else:
+            try:
+                buf = self.free.get_nowait()
+            except queue.Empty: # writer is behind
+                self.drop()
+                if self.policy == 'repeat' and self.written:
+                    self.put(REPEAT)
+                return
+        np.copyto(buf, canvas)
+        self.written = True
+        self.put(buf)
+
+    def put(self, item):
+        if self.policy == 'block':
+            self.frames.put((item, time.monotonic()))
+            return
+        try:
+            self.frames.put_nowait((item, time.monotonic()))
+        except queue.Full:
+            self.drop()
+            if item is not REPEAT:
+                self.free.put(item)
+
+    def drop(self):
+        self.dropped += 1
+        metrics.inc('streamview_output_dropped_total')
+
+    def run(self): # writer thread
+        last = None # last frame written
+        count = 0   # frames in the open segment
+        while True:
+            item, composited = self.frames.get()
+            if item is STOP:
+                break
+            if self.handle is None or (self.segment > 0 and count >= self.segment * self.fps) or \
+               (self.segmentbytes > 0 and count % self.fps == 0 and os.path.getsize(self.path) >= self.segmentbytes):
+                self.rotate()
+                count = 0
+            t0 = time.perf_counter()
+            if item is REPEAT:
+                if last is not None:
+                    self.handle.write(last)
+                    count += 1
+                    metrics.timed('streamview_encode_seconds', t0)
+                    metrics.observe('streamview_latency_encode_seconds', time.monotonic() - composited)
+                continue
+            self.handle.write(item)
+            metrics.timed('streamview_encode_seconds', t0)
+            metrics.observe('streamview_latency_encode_seconds', time.monotonic() - composited)
+            count += 1
+            if last is not None:
+                self.free.put(last)
+            last = item
+        if self.handle is not None:
+            self.handle.release()
+
+    def rotate(self): # finish the open segment, start the next
+        if self.handle is not None:
+            self.handle.release()
+        self.segments += 1
+        self.path = self.filename()
+        self.handle = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*'mp4v'), float(self.fps), self.size)
+
+    def close(self): # write the queued frames, then close the file
+        if self.thread is not None:
+            self.frames.put((STOP, None))
+            self.thread.join()
+            self.thread = None
+
+############################################################################
+# Publish rendered frames as binary video message, so a headless viewer can
+# be watched by another streamview. only changed frames are sent
+############################################################################
+class PublishSink(object):
+
+    def __init__(self, context, port, name = "streamview", host = "*", buffers = 4):
+        self.name = name
+        self.msg = util.oMsg(context, port, host = host, conflate = True, binary = True, colormodel = 'bgr')
+        self.buffers = buffers
+        self.sent = [] # (buffer, zmq tracker), oldest first
+
+    def write(self, canvas, damage):
+        if len(damage) > 0:
+            buf = self.buffer(canvas)
+            np.copyto(buf, canvas) # sent zero copy - the canvas changes while zmq still holds the frame
+            self.sent.append((buf, self.msg.send({self.name : buf}, track = True)))
+
+    def buffer(self, canvas): # a frame buffer zmq is done with
+        for i, (buf, tracker) in enumerate(self.sent):
+            if tracker.done:
+                return self.sent.pop(i)[0]
+        if len(self.sent) < self.buffers:
+            return np.empty_like(canvas)
+        buf, tracker = self.sent.pop(0)
+        tracker.wait() # short: the send queue holds two frames, slow subscribers are dropped
+        return buf
+
+    def close(self):
+        self.msg.sock.close()
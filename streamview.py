@@ -5,16 +5,20 @@ import sys
 
 import cv2
 import zmq
+import math
 import time
 import numpy as np
 
 import video
 import graph
 import util
+import sink
+import metrics
+import recording
 
 import argparse
 
-import pickle
+STATUSINTERVAL = 0.5 # seconds between status line updates
 
 ############################################################################
 # Streamview main class - manages inputs, videos, graphs, video creation 
@@ -22,7 +26,10 @@ import pickle
 class Streamview(object):
 
     def __init__(self, kb, introtxt, image_msg, graph_msg, canvas_h, canvas_w, fps, savevideo,
-        videopath, videocolormodel, videoscalingfactor, graphcols, videocols, pickleoutputfile):
+        videopath, videocolormodel, videoscalingfactor, graphcols, videocols, recordpath = None, videothreads = 1, graphtimespan = 0, graphautoscale = False, videoworkers = 0,
+        headless = False, renderport = None, videoqueue = 8, videodrop = 'repeat', videosegment = 0, videosegmentmb = 0,
+        metricsfile = None, metricsport = None, metricsinterval = 1.0, latencyoverlay = False, recordcompress = 0,
+        replay = None): # replay: recording.Replay the message sources come from
 
        self.introtxt      = introtxt
        self.kb            = kb
@@ -35,87 +42,249 @@ class Streamview(object):
        self.videopath     = videopath
        self.graphcols     = graphcols
        self.videocols     = videocols
-       self.videohandle   = None
+       self.graphtimespan = graphtimespan
+       self.graphautoscale = graphautoscale
+       self.display       = not headless # show the canvas in a window. headless: render to the sinks only
+       self.sinks         = [] # receive every rendered canvas
        self.basetime      = None
        self.lastsnapped   = 0
-       self.pickleoutputfile = pickleoutputfile
+       self.stale         = True # canvas changed outside of box flushes ( intro, wipe ) - show it
+       self.damage        = []   # areas changed by the last flush
+       self.lastprinted   = 0    # status line time
+       self.received      = []   # (graph, receive time) of messages not composited yet
+       self.vreceived     = {}   # video : receive time of the image not composited yet
+       self.latencyoverlay = latencyoverlay
+       self.overlaytext   = ""
+       self.overlaycounts = {}   # latency histogram counts at the last overlay update
+       self.lastoverlay   = 0
+       self.export        = metrics.Export(metricsfile, metricsport, metricsinterval) if metricsfile is not None or metricsport is not None else None
+       if self.export is not None or latencyoverlay: # not free - only collected when used
+           metrics.enable()
+       self.recordpath    = recordpath
+       self.recordcompress = recordcompress
+       self.recorder      = None # written by the render and the video receive thread
+       self.replay        = replay
+       self.clock         = replay.clock if replay is not None else time.time # frame timing and message times
+       self.receiver      = video.VideoReceiver(self.image_msg, self.videocolormodel,
+           record = lambda m: self.record(self.image_msg.port, m, self.image_msg.meta)) if videothreads > 0 and image_msg.sock is not None else None
            
        self.canvas = np.full((canvas_h, canvas_w, 3), (255,255,255), dtype=np.uint8)
        self.box = util.Box(self.canvas, None, 0, 0, canvas_w, canvas_h)
 
        self.ibox = util.Box(self.canvas, None, self.box.sbxoffs(), self.box.sbyoffs(), self.box.sbwidth(), 0)
-       self.videos = video.VideoSet(self.canvas,self.ibox, cols=videocols, videocolormodel = self.videocolormodel)
+       self.videos = video.VideoSet(self.canvas,self.ibox, cols=videocols, videocolormodel = self.videocolormodel, scale = self.scale,
+           workers = videoworkers, reserve = graph.MINROWHEIGHT if graphcols > 0 else 0) # graphs keep at least one row
        self.dbox = util.Box(self.canvas, None, self.box.sbxoffs(), self.box.sbyoffs(), self.box.sbwidth(), self.box.sbheight())
-       self.panels = graph.Panels(self.canvas, self.dbox, cols=graphcols)
+       self.panels = graph.Panels(self.canvas, self.dbox, cols=graphcols, timespan=graphtimespan, autoscale=graphautoscale)
 
        self.intro()
 
        if self.savevideo:
-           if not os.path.exists("./{}".format(self.videopath)):
-               os.makedirs(self.videopath)
-           self.videohandle = cv2.VideoWriter("{}/video-{}-{}.mp4".format(self.videopath, time.strftime("%Y%m%d"),
-                time.strftime("%H%M")), cv2.VideoWriter_fourcc(*'mp4v'), float(fps), (self.canvas.shape[1], self.canvas.shape[0]))
+           self.sinks.append(sink.VideoFileSink(self.videopath, fps, (self.canvas.shape[1], self.canvas.shape[0]),
+               queuesize = videoqueue, policy = videodrop, segment = videosegment, segmentmb = videosegmentmb))
+       if renderport is not None:
+           self.sinks.append(sink.PublishSink(zmq.Context.instance(), renderport))
 
     def intro(self, fontsize = 0.8, fonttype = 2):
-        (label_width, label_height), baseline = cv2.getTextSize(self.introtxt, fonttype, fontsize, 1)
+        (label_width, label_height), baseline = util.textcache.size(self.introtxt, fonttype, fontsize)
         self.box.print(self.introtxt, int(0.5 * self.box.sbwidth()) - int(0.5 * label_width), int(0.5 * self.box.sbheight()),
             fonttype, fontsize, color = 0, tocanvas = True)
   
     def __del__(self): # destructor - needed to release video handle & flush video
-       if self.savevideo and self.videohandle is not None:
-           self.videohandle.release()
-
-    def process_snapshot(self): # generate & display monitor image
-        self.videos.flush()
-        self.panels.flush()
-        if self.savevideo:
-            self.videohandle.write(self.canvas)
-        cv2.imshow("streaming data viewer", self.canvas)
-        cv2.waitKey(1)
-
-    def snap(self):
+       self.close()
+
+    def close(self): # end of run - not left to the destructor: the receiver's record callback keeps self alive
+       for s in self.sinks:
+           s.close()
+       self.sinks = []
+       if self.export is not None:
+           self.export.close()
+           self.export = None
+       if self.recorder is not None:
+           self.recorder.close()
+           self.recorder = None
+
+    def wipe(self):
+        self.box.wipe()
+        self.stale = True
+
+    def process_snapshot(self): # generate & display monitor image. only changed boxes are composited
+        t0 = time.perf_counter()
+        self.damage = self.videos.flush() + self.panels.flush()
+        metrics.timed('streamview_flush_seconds', t0)
+        metrics.inc('streamview_frames_total')
+        composited = time.monotonic()
+        for name, received in self.received + [r for r in self.vreceived.items() if r[0] in self.videos.videos]:
+            metrics.observe('streamview_latency_composite_seconds', composited - received, stream = name)
+        self.received, self.vreceived = [], {}
+        under = self.overlay() if self.latencyoverlay else None
+        for s in self.sinks: # nothing changed: the canvas is still the previous frame - repeat it
+            s.write(self.canvas, self.damage)
+        if self.display:
+            t0 = time.perf_counter()
+            if len(self.damage) > 0 or self.stale:
+                self.stale = False
+                cv2.imshow("streaming data viewer", self.canvas)
+            cv2.waitKey(1)
+            metrics.timed('streamview_imshow_seconds', t0)
+            metrics.observe('streamview_latency_display_seconds', time.monotonic() - composited)
+        if under is not None: # the overlay is not part of any box - put back what it covers
+            x, y, pixels = under
+            self.canvas[y : y + pixels.shape[0], x : x + pixels.shape[1]] = pixels
+
+    def overlay(self, fontsize = 0.4, fonttype = 2): # latency percentiles of the last status interval, bottom left. returns covered pixels
+        if time.time() - self.lastoverlay >= STATUSINTERVAL:
+            self.lastoverlay = time.time()
+            text = "latency ms p50/p99"
+            for label, name in (("net", 'streamview_latency_receive_seconds'), ("comp", 'streamview_latency_composite_seconds'),
+                    ("show", 'streamview_latency_display_seconds'), ("enc", 'streamview_latency_encode_seconds')):
+                counts = metrics.registry.counts(name)
+                if counts is None:
+                    continue
+                recent = [c - p for c, p in zip(counts, self.overlaycounts.get(name, [0] * len(counts)))]
+                self.overlaycounts[name] = counts
+                if sum(recent) > 0:
+                    text += "  {} {:.1f}/{:.1f}".format(label, 1000 * metrics.quantile(name, 0.5, recent), 1000 * metrics.quantile(name, 0.99, recent))
+            if text != self.overlaytext:
+                self.overlaytext = text
+                self.stale = True
+        (w, h), baseline = util.textcache.size(self.overlaytext, fonttype, fontsize)
+        w, h = min(w + 4, self.canvas.shape[1]), h + baseline + 4
+        x, y = 0, self.canvas.shape[0] - h
+        under = (x, y, self.canvas[y : y + h, x : x + w].copy())
+        self.canvas[y : y + h, x : x + w] = 255
+        util.textcache.put(self.canvas[y : y + h, x : x + w], self.overlaytext, (2, h - baseline - 2), fonttype, fontsize, (0, 0, 0))
+        if self.stale:
+            self.damage.append((x, y, w, h))
+        return under
+
+    def snap(self): # render frame when due. returns seconds until the next frame deadline
         if self.basetime is None:
-            self.basetime = time.time()
-        snapped = round((time.time() - self.basetime)*self.fps)
+            self.basetime = self.clock()
+        snapped = round((self.clock() - self.basetime)*self.fps)
         if snapped > self.lastsnapped:
            self.lastsnapped = snapped
            self.process_snapshot()
+        return max(0, self.basetime + (self.lastsnapped + 0.5) / self.fps - self.clock())
+
+    def poller(self): # wait on both message sockets and the keyboard instead of spinning. replay sources have no socket
+        poller = zmq.Poller()
+        if self.graph_msg.sock is not None:
+            poller.register(self.graph_msg.sock, zmq.POLLIN)
+        if self.receiver is None and self.image_msg.sock is not None: # otherwise the socket belongs to the receive thread
+            poller.register(self.image_msg.sock, zmq.POLLIN)
+        if self.kb.fileno() is not None:
+            poller.register(self.kb.fileno(), zmq.POLLIN)
+        return poller
+
+    def deadline(self): # time at which the next frame is due
+        return self.clock() if self.basetime is None else self.basetime + (self.lastsnapped + 0.5) / self.fps
+
+    def record(self, port, message, meta = None, t = None): # t: receive time
+        if self.recorder is not None:
+            self.recorder.write(port, self.clock() if t is None else t, message, meta)
+
+    def drain(self, source, until): # read all queued messages, up to the time budget. at least one
+        messages = []
+        while True:
+            message = source.read()
+            if message is None:
+                break
+            t = source.time if self.replay is not None else self.clock() # replayed: the recorded receive time, not the frame wake-up
+            self.record(source.port, message, source.meta, t)
+            messages.append((message, source.meta, t, source.received))
+            if self.clock() >= until:
+                break
+        return messages
+
+    def keypress(self, key): # runtime controls, 'q' is handled by the main loop
+        if key in ('z', 'Z'): # graph window: zoom out / in over the history pyramid
+            self.panels.cyclezoom(1 if key == 'z' else -1)
+
+    def update_graphs(self, messages):
+        for graph_msg, _, t, received in messages:
+            for name in graph_msg.keys(): 
+               metrics.inc('streamview_graph_messages_total', stream = name)
+               self.received.append((name, received))
+               self.panels.update(name, graph_msg[name], t)
+
+    def latest_images(self, messages): # conflate per stream - only the latest image of each stream is of interest
+        images = {}
+        for image_msg, meta, _, received in messages:
+            for name, image in image_msg.items():
+               metrics.inc('streamview_video_frames_total', stream = name)
+               if name in images:
+                  metrics.inc('streamview_video_dropped_total', stream = name)
+               images[name] = (image, meta.get(name, {}).get("color"), received)
+        return images
+
+    def update_videos(self, images): # images: name : (image, colormodel, receive time)
+        for name, (image, colormodel, received) in images.items():
+           self.videos.update(name, image, self.wipe, colormodel = colormodel)
+           self.vreceived[name] = received # replaced images are never composited
+           if self.videos.redrawn:
+              isize = self.videos.box.height
+              self.dbox = util.Box(self.canvas, None, self.box.sbxoffs(), self.box.sbyoffs()+isize, self.box.sbwidth(), self.box.sbheight() - isize)
+              self.panels = graph.Panels(self.canvas, self.dbox, cols=self.graphcols, timespan=self.graphtimespan, prev=self.panels,
+                  autoscale=self.graphautoscale)
+              self.redrawn = False
 
     ##########################################################################
     # main loop
     ##########################################################################
     def run(self, gidx = 0, vidx = 0):
 
-      pf = open("{}{}".format(self.pickleoutputfile, ".dat"), "wb") if self.pickleoutputfile is not None else None
+      self.recorder = recording.Recorder(self.recordpath, self.recordcompress) if self.recordpath is not None else None
 
-      while not self.kb.quit():
-  
-         graph_msg = self.graph_msg.read() # check for data message
-         if graph_msg is not None:
-            gidx += 1
-            if pf is not None:
-                pickle.dump((args.graphport, time.time(), graph_msg), pf)
-            for name in graph_msg.keys(): 
-               self.panels.update(name, graph_msg[name])
+      if self.receiver is not None:
+         self.receiver.start()
 
-         image_msg = self.image_msg.read()  # check for image message
-         if image_msg is not None:
-            vidx += 1
-            if pf is not None:
-                pickle.dump((args.videoport, time.time(), image_msg), pf)
-            for name, image in image_msg.items():
-               if self.scale != 1:  
-                  image = cv2.resize(image, (round(self.scale * image.shape[1]), round(self.scale * image.shape[0])), interpolation = cv2.INTER_AREA if self.scale < 1 else cv2.INTER_LINEAR)
-               self.videos.update(name, image, self.box.wipe)
-               if self.videos.redrawn:
-                  isize = self.videos.box.height
-                  self.dbox = util.Box(self.canvas, None, self.box.sbxoffs(), self.box.sbyoffs()+isize, self.box.sbwidth(), self.box.sbheight() - isize)
-                  self.panels = graph.Panels(self.canvas, self.dbox, cols=self.graphcols)
-                  self.redrawn = False
-
-         print("\rgraph frames: {:6d}, video frames {:6d}".format(gidx, vidx), end="", flush=True)
-
-         self.snap()
+      poller = self.poller()
+      wait = 0
+
+      try:
+         while not self.kb.quit() and not (self.replay is not None and self.replay.finished()):
+
+            if len(poller.sockets) > 0:
+               ready = dict(poller.poll(timeout = math.ceil(1000 * wait))) # block until a message or key arrives, or the next frame is due
+            else: # replay without keyboard: nothing to wait on, poll would return at once
+               time.sleep(wait)
+               ready = {}
+            self.keypress(self.kb.key)
+
+            # batched ingest: drain each socket until empty or the next frame is due, then render once
+            until = self.deadline() if self.replay is None else math.inf # replay: everything due - bounded by the recording, no budget
+            graph_msgs = self.drain(self.graph_msg, until) if self.graph_msg.sock is None or self.graph_msg.sock in ready else []
+            self.update_graphs(graph_msgs)
+
+            if self.receiver is not None: # images are received and preprocessed by the receive thread
+               images = self.receiver.mailbox.take()
+               vcount, vidx = self.receiver.count - vidx, self.receiver.count
+            else:
+               image_msgs = self.drain(self.image_msg, until) if self.image_msg.sock is None or self.image_msg.sock in ready else []
+               images = self.latest_images(image_msgs)
+               vcount = len(image_msgs)
+               vidx += vcount
+            self.update_videos(images)
+
+            gidx += len(graph_msgs)
+            if (len(graph_msgs) > 0 or vcount > 0) and time.time() - self.lastprinted >= STATUSINTERVAL: # printing is not free - throttled
+               self.lastprinted = time.time()
+               dropped = ", dropped {:6d}".format(int(metrics.registry.value('streamview_video_dropped_total'))) if metrics.enabled else ""
+               print("\rgraph frames: {:6d}, video frames {:6d}{}".format(gidx, vidx, dropped), end="", flush=True)
+
+            wait = self.snap()
+            if self.replay is not None: # replay seconds to wall clock seconds
+               wait = self.replay.sleep(wait)
+            if self.export is not None:
+               self.export.poll()
+
+         if self.replay is not None and self.replay.finished(): # the last messages are not rendered yet
+            self.process_snapshot()
+      finally: # also on ctrl-c or errors: the video file is only playable once closed
+         if self.receiver is not None:
+            self.receiver.stop()
+         self.close()
    
 ############################################################################
 # main
@@ -127,6 +296,10 @@ if __name__ == "__main__":
    parser.add_argument('-height', help="viewer window pixel height", default=680, type=int)
    parser.add_argument('-savevideo', help="save viewer data as video file", action='store_true', default=True)
    parser.add_argument('-videopath', help="video output directory", default='FILES')
+   parser.add_argument('-videoqueue', help="video output frames queued for the encoder", type=int, default=8)
+   parser.add_argument('-videodrop', help="video output when the encoder falls behind: repeat the previous frame, drop the frame or block (default: repeat, block when replaying)", choices=['repeat','drop','block'])
+   parser.add_argument('-videosegment', help="start a new video file every this many seconds of video (0: one file)", type=float, default=0)
+   parser.add_argument('-videosegmentmb', help="start a new video file when the current one reaches this size in MB (0: no limit)", type=float, default=0)
    parser.add_argument('-fps', help="viewer and video output frame rate", type=int, default=25)
    parser.add_argument('-videocolormodel', help="video input color subpixel order", default='rgb', choices=['bgr','rgb'])
    parser.add_argument('-videoscalingfactor', help="input video scaling factor", type=float, default=1)
@@ -135,7 +308,23 @@ if __name__ == "__main__":
    parser.add_argument('-vp', '--videoport', help='video source port number', type=int, default=5550)
    parser.add_argument('-gc', '--graphcols', help='number of graph columns', default=1, type=int, choices=range(0, 6))
    parser.add_argument('-vc', '--videocols', help='number of video columns', default=2, type=int, choices=range(0, 6))
-   parser.add_argument('-po', '--pickleoutputfile', help="pickle stream messages output file")
+   parser.add_argument('-rec', '--recordpath', help="record stream messages to this directory")
+   parser.add_argument('-re', '--replay', help="replay a recording ( directory, or pickle file of older versions ) instead of receiving")
+   parser.add_argument('-rs', '--replayspeed', help='replay speed factor (0: as fast as possible)', default=1.0, type=float)
+   parser.add_argument('-rt', '--replaystart', help='replay from this many seconds into the recording', default=0, type=float)
+   parser.add_argument('-rz', '--recordcompress', help='recording zlib compression level (0: none)', default=0, type=int, choices=range(0, 10))
+   parser.add_argument('-gt', '--graphtimespan', help='seconds per graph pixel column (0: one column per message)', default=0, type=float)
+   parser.add_argument('-ga', '--graphautoscale', help='autoscale graph y-axes that have no min/max in their scale definition', action='store_true', default=False)
+   parser.add_argument('-vt', '--videothreads', help='receive video on a background thread (0: on the render thread)', default=1, type=int, choices=range(0, 2))
+   parser.add_argument('-hl', '--headless', help='no display window and no terminal input - render to the video file and sinks only', action='store_true', default=False)
+   parser.add_argument('-cp', '--controlport', help='headless: port of the command socket ( zmq PUSH one key commands, e.g. "q" )', type=int)
+   parser.add_argument('-ch', '--controlhost', help='headless: interface the command socket binds to ( * : all )', default='127.0.0.1')
+   parser.add_argument('-rp', '--renderport', help='publish rendered frames as video messages on this port', type=int)
+   parser.add_argument('-mf', '--metricsfile', help='write pipeline metrics to this file, in prometheus text format')
+   parser.add_argument('-mp', '--metricsport', help='publish pipeline metrics, in prometheus text format, on this local port', type=int)
+   parser.add_argument('-mi', '--metricsinterval', help='seconds between metrics exports', default=1.0, type=float)
+   parser.add_argument('-lo', '--latencyoverlay', help='show latency percentiles at the bottom of the viewer', action='store_true', default=False)
+   parser.add_argument('-vw', '--videoworkers', help='threads converting and scaling video streams in parallel (0: one stream at a time)', default=min(8, os.cpu_count() or 1), type=int)
 
    args = parser.parse_args()
 
@@ -148,18 +337,26 @@ if __name__ == "__main__":
    print("\nSettings:\n")
    for arg in vars(args):
      print ("{:<12}= {}".format(arg, getattr(args, arg)))
-   print("\nEnter 'q' to stop")
+   if args.headless:
+     print("\nSend SIGINT or SIGTERM{} to stop".format(", or 'q' to port {},".format(args.controlport) if args.controlport is not None else ""))
+   else:
+     print("\nEnter 'q' to stop, 'z' / 'Z' to zoom graphs out / in")
 
-   # conflate=true: let new incoming video images overwrite any unprocessed messades in queue. in case we cannot keep up
+   # conflate=false: video messages from several publishers may carry different streams. the queue is drained and
+   #    conflated per stream name instead, so every stream keeps its own latest image. hwm bounds the queue memory
 
-   image_msg = util.iMsg(zmq.Context(), args.videoport, host=args.hostname, conflate = True) # dict: name : image
+   image_msg = util.iMsg(zmq.Context(), args.videoport, host=args.hostname, conflate = False, hwm = 16) # dict: name : image
 
    # conflate=false: let incoming data messages queue up. only relevant when imdisplay is being resized and queue processing is suspended.
    #    in all other cases we have no issue keeping up
 
    graph_msg = util.iMsg(zmq.Context(), args.graphport, host=args.hostname, conflate = False) # dict arrray: [ name : tuple ]
 
-   Streamview(util.KBHit(),
+   replay = recording.Replay(args.replay, speed = args.replayspeed, start = args.replaystart) if args.replay is not None else None
+   if replay is not None: # messages come from the recording
+      image_msg, graph_msg = replay.source('video'), replay.source('graph')
+
+   Streamview(util.Control(args.controlport, host = args.controlhost) if args.headless else util.KBHit(),
         introtxt    = "Waiting for streaming data ..",
         image_msg    = image_msg,
         graph_msg    = graph_msg,
@@ -172,4 +369,20 @@ if __name__ == "__main__":
         videoscalingfactor= args.videoscalingfactor,
         graphcols    = args.graphcols,
         videocols    = args.videocols,
-        pickleoutputfile   = args.pickleoutputfile).run()
+        recordpath   = args.recordpath,
+        recordcompress = args.recordcompress,
+        replay       = replay,
+        videothreads = args.videothreads,
+        graphtimespan = args.graphtimespan,
+        graphautoscale = args.graphautoscale,
+        videoworkers = args.videoworkers,
+        headless = args.headless,
+        renderport = args.renderport,
+        videoqueue = args.videoqueue,
+        videodrop = args.videodrop or ('block' if replay is not None else 'repeat'), # offline: every frame counts
+        videosegment = args.videosegment,
+        videosegmentmb = args.videosegmentmb,
+        metricsfile = args.metricsfile,
+        metricsport = args.metricsport,
+        metricsinterval = args.metricsinterval,
+        latencyoverlay = args.latencyoverlay).run()
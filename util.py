@@ -3,9 +3,15 @@ import sys
 import zmq
 import numpy as np
 import math
+import json
+import time
+import pickle
+import signal
 import platform
 
-from collections import deque
+import metrics
+
+from collections import deque, OrderedDict
 
 # import libraries needed for getch on *nix
 try:
@@ -63,6 +69,7 @@ class Colors(object):
 class KBHit:
 
     def __init__(self):
+        self.key = None # last key read by quit
         self.system = platform.system()
         assert self.system == "Linux" or self.system == "Darwin" or self.system == "Windows"
         if self.system == "Linux" or self.system == "Darwin": 
@@ -99,7 +106,125 @@ class KBHit:
             return msvcrt.kbhit()
 
     def quit(self):
-        return (self.kbhit() and self.getch() == 'q')
+        self.key = self.getch() if self.kbhit() else None
+        return self.key == 'q'
+
+    def fileno(self): # file descriptor to wait on for key presses, None if not pollable ( windows console )
+        if self.system == "Linux" or self.system == "Darwin": 
+            return self.fd
+        return None
+
+############################################################################
+# Headless control - same interface as KBHit, without a terminal. SIGINT and
+# SIGTERM quit, an optional zmq PULL socket takes the same key commands as
+# strings. commands are picked up once per main loop iteration
+############################################################################
+class Control(object):
+
+    def __init__(self, port = None, context = None, host = "127.0.0.1"): # host: interface the command socket binds to, "*": all
+        self.key = None # last key read by quit
+        self.commands = deque()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: self.commands.append('q'))
+        self.sock = None
+        if port is not None:
+            self.sock = (context or zmq.Context.instance()).socket(zmq.PULL)
+            self.sock.bind("tcp://{}:{}".format(host, port))
+
+    def getch(self):
+        return self.commands.popleft() if self.commands else ''
+
+    def kbhit(self):
+        while self.sock is not None:
+            try:
+                self.commands.extend(self.sock.recv_string(flags = zmq.NOBLOCK))
+            except zmq.Again:
+                break
+        return len(self.commands) > 0
+
+    def quit(self):
+        self.key = self.getch() if self.kbhit() else None
+        return self.key == 'q'
+
+    def fileno(self): # nothing to wait on - the main loop wakes up for every frame
+        return None
+
+############################################################################
+# Text cache - font metrics and pre-rendered rotated text sprites. rotated
+# text is rendered once as alpha mask, then blended into the window. plain
+# text goes straight to cv2.putText, which is as fast as a sprite blend for
+# short labels. whole labels are cached - glyph advances don't add up.
+# blended edges can differ from putText on a rotated window by one level
+############################################################################
+class TextCache(object):
+    def __init__(self, maxsprites = 4096, pad = 2):
+        self.metrics = {}
+        self.sprites = OrderedDict() # least recently used first
+        self.maxsprites = maxsprites
+        self.pad = pad
+
+    def size(self, txt, fonttype, fontsize, thickness = 1): # same result as cv2.getTextSize
+        key = (txt, fonttype, fontsize, thickness)
+        metrics = self.metrics.get(key)
+        if metrics is None:
+            if len(self.metrics) >= 4 * self.maxsprites: # labels with changing values - don't grow forever
+                self.metrics.clear()
+            metrics = self.metrics[key] = cv2.getTextSize(txt, fonttype, fontsize, thickness)
+        return metrics
+
+    def shrink(self, txt, fonttype, fontsize, width): # largest font size, in 2% steps, that fits txt in width
+        key = ("shrink", txt, fonttype, fontsize, width)
+        shrunk = self.metrics.get(key)
+        if shrunk is None:
+            shrinkfontsize = fontsize
+            while True:
+                (txt_w, _), _ = self.size(txt, fonttype, shrinkfontsize)
+                if txt_w < width:
+                    break
+                shrinkfontsize *= 0.98
+            shrunk = self.metrics[key] = (txt_w, shrinkfontsize)
+        return shrunk
+
+    def sprite(self, txt, fonttype, fontsize, color, rotation): # rotated text as alpha mask
+        key = (txt, fonttype, fontsize, color, rotation)
+        sprite = self.sprites.get(key)
+        if sprite is not None:
+            self.sprites.move_to_end(key)
+            return sprite
+        (w, h), baseline = self.size(txt, fonttype, fontsize)
+        mask = np.zeros((h + baseline + 2 * self.pad, w + 2 * self.pad), dtype = np.uint8)
+        cv2.putText(mask, txt, (self.pad, self.pad + h), fonttype, fontsize, 255, 1, cv2.LINE_AA)
+        mask = cv2.rotate(mask, cv2.ROTATE_90_COUNTERCLOCKWISE)
+        alpha = mask.astype(np.float32) / 255
+        sprite = (1 - alpha, alpha, np.full(mask.shape + (3,), color, dtype = np.uint8), h) # inverse alpha, alpha, color
+        self.sprites[key] = sprite
+        if len(self.sprites) > self.maxsprites:
+            self.sprites.popitem(last = False)
+        return sprite
+
+    def put(self, win, txt, coord, fonttype, fontsize, color, rotation = 0): # like cv2.putText. rotation: 90 is clockwise, as seen from the text
+        if not rotation:
+            cv2.putText(win, txt, coord, fonttype, fontsize, color, 1, cv2.LINE_AA)
+            return
+        if type(color) is not tuple:
+            color = tuple(color) if hasattr(color, '__len__') else (color, 0, 0) # cv2 scalar semantics
+        inv, alpha, fill, h = self.sprite(txt, fonttype, fontsize, color, rotation)
+        sh, sw = inv.shape
+        x, y = coord[0] - self.pad, coord[1] - h - self.pad # sprite top left, in the window rotated clockwise
+        x, y = y, win.shape[0] - x - sh # map back
+        if x >= 0 and y >= 0 and x + sw <= win.shape[1] and y + sh <= win.shape[0]: # fully inside
+            region = win[y:y + sh, x:x + sw]
+            region[:] = cv2.blendLinear(region, fill, inv, alpha)
+            return
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(win.shape[1], x + sw), min(win.shape[0], y + sh)
+        if x1 <= x0 or y1 <= y0:
+            return
+        region = win[y0:y1, x0:x1]
+        sy, sx = slice(y0 - y, y1 - y), slice(x0 - x, x1 - x)
+        region[:] = cv2.blendLinear(region, fill[sy, sx], inv[sy, sx], alpha[sy, sx])
+
+textcache = TextCache()
 
 ############################################################################
 # Box coordinate & margin handling
@@ -115,6 +240,8 @@ class Box(object):
         self.fill    = fill
         self.fontsize = fontsize
         self.titled  = False
+        self.framed  = False # border painted
+        self.dirty   = True  # win changed since last flush
         self.overflow = False
         self.win      = None
         self.border   = border
@@ -123,7 +250,7 @@ class Box(object):
             topbotmargin += 3
             sidemargin += 3
  
-        (_, text_h), _ = cv2.getTextSize("()", 2, self.fontsize, 1) # use fixed text for height so title_margin is not dependent on the actual text
+        (_, text_h), _ = textcache.size("()", 2, self.fontsize) # use fixed text for height so title_margin is not dependent on the actual text
         self.title_margin = (text_h+4) if (self.name is not None)  else 0
 
         # if height is negative: use if as sbheight, and calculate the resulting height
@@ -153,17 +280,14 @@ class Box(object):
                self.win = np.full((self.sbheight(), self.sbwidth(), 3), (self.fill, self.fill, self.fill), dtype=np.uint8)
            if self.win is not None:
               self.print_low(self.win, txt, (x, y), fonttype, fontsize, color, rotation)
+              self.dirty = True
 
     def print_low(self, win, txt, coord, fonttype, fontsize, color, rotation):
-       if rotation:
-          rot = cv2.rotate(win, cv2.ROTATE_90_CLOCKWISE) 
-          cv2.putText(rot, txt, coord, fonttype, fontsize, color, 1, cv2.LINE_AA)
-          win[:,:,:] = cv2.rotate(rot, cv2.ROTATE_90_COUNTERCLOCKWISE)
-       else:
-           cv2.putText(win, txt, coord, fonttype, fontsize, color, 1, cv2.LINE_AA)
+       textcache.put(win, txt, coord, fonttype, fontsize, color, rotation) # rotation: coord is in the window rotated clockwise
 
     def forcewin(self): # force win into existence. needed for windows that don't use box.print 
         self.win = np.full((self.sbheight(), self.sbwidth(), 3), (self.fill, self.fill, self.fill), dtype=np.uint8)
+        self.dirty = True
 
     def wipe(self):
         assert self.overflow is False
@@ -174,27 +298,32 @@ class Box(object):
         assert self.overflow is False
         if self.canvas is not None:
             self.win = win
+            self.dirty = True
 
     def shrinktext(self):
-        shrinkfontsize = self.fontsize
-        while True:
-            (name_w, _), _ = cv2.getTextSize(self.name, 2, shrinkfontsize, 1) 
-            if name_w < self.width:
-                break
-            shrinkfontsize *= 0.98
-        return name_w, shrinkfontsize
+        return textcache.shrink(self.name, 2, self.fontsize, self.width)
 
-    def flush(self):
+    def flush(self, rollofs = 0): # rollofs: win is a circular column buffer, starting at this column
+        # copies win only if changed, title and border are static and painted once. returns the damaged area, None if nothing changed
         assert self.overflow is False
-        if self.canvas is not None and self.win is not None:
-            self.canvas[self.sbyoffs() : self.sbyoffs() + self.win.shape[0], self.sbxoffs() : self.sbxoffs() + self.win.shape[1]] = self.win
+        damage = None
+        if self.canvas is not None and self.win is not None and self.dirty:
+            h, w = self.win.shape[0], self.win.shape[1]
+            self.canvas[self.sbyoffs() : self.sbyoffs() + h, self.sbxoffs() : self.sbxoffs() + w - rollofs] = self.win[:, rollofs:]
+            if rollofs > 0:
+                self.canvas[self.sbyoffs() : self.sbyoffs() + h, self.sbxoffs() + w - rollofs : self.sbxoffs() + w] = self.win[:, :rollofs]
+            damage = (self.sbxoffs(), self.sbyoffs(), w, h)
+        self.dirty = False
         if self.canvas is not None:
            if not self.titled and self.title_margin > 0: # put title at top, horizontally centered
                name_w, shrinkfontsize = self.shrinktext()
-               cv2.putText(self.canvas, self.name, (self.xoffs + max(0, int(self.width/2 - name_w/2)), self.sbyoffs() - 3), 2, shrinkfontsize, (120,120,120), 1, cv2.LINE_AA)
+               textcache.put(self.canvas, self.name, (self.xoffs + max(0, int(self.width/2 - name_w/2)), self.sbyoffs() - 3), 2, shrinkfontsize, (120,120,120))
                self.titled = True
+               damage = (self.xoffs, self.yoffs, self.width, self.height)
            # grid lines
-        if self.border and self.canvas is not None:
+        if self.border and self.canvas is not None and not self.framed:
+           self.framed = True
+           damage = (self.xoffs, self.yoffs, self.width, self.height)
            assert self.topbotmargin > 0 
            assert self.sidemargin > 0
 
@@ -211,6 +340,15 @@ class Box(object):
 
            #print(      -1+self.yoffs, "-",   -1+self.yoffs+self.height,-1+self.xoffs + self.width-1)
            self.canvas[1+self.yoffs: -1+self.yoffs+self.height,-1+self.xoffs + self.width-1] = (200,200,200)
+        return damage
+
+    def move(self, xoffs, yoffs): # same size, new place. title, border and win are repainted by the next flush
+        self.xoffs = xoffs
+        self.yoffs = yoffs
+        self.calc(self.height, self.topbotmargin, self.sidemargin)
+        self.titled = False
+        self.framed = False
+        self.dirty = True
 
     def sbyoffs(self): 
         return self.yoffs + self.topbotmargin + self.title_margin
@@ -221,33 +359,134 @@ class Box(object):
     def sbwidth(self): # 
         return self.width - (2 * self.sidemargin)
 
+############################################################################
+# Latest value per key, handed from one writer thread to one reader thread.
+# lock free - relies on dict item assignment and pop being atomic
+############################################################################
+class Mailbox(object):
+    def __init__(self):
+        self.slots = {}
+
+    def put(self, key, value): # overwrites any value not taken yet. returns True if it did
+        replaced = key in self.slots
+        self.slots[key] = value
+        return replaced
+
+    def take(self): # newest value for each key put since the last take
+        values = {}
+        for key in list(self.slots):
+            value = self.slots.pop(key, None)
+            if value is not None:
+                values[key] = value
+        return values
+
 MONITOR_VIDEO    = 5550  # image based monitoring messages
 MONITOR_GRAPH    = 5551  # data based monitoring messages
 
+############################################################################
+# Binary frame protocol - multipart message: tag frame, then a (header, buffer)
+# frame pair per stream. headers are small json dicts, buffers are raw numpy data.
+# single frame messages are pickled python objects ( = legacy format ).
+# stamped: "sent" is the publisher's time.monotonic() at send - comparable
+# on the same host only. pickled messages then get a tag and a json stamp frame
+############################################################################
+FRAMES_TAG = b"streamview/frames"
+STAMPED_TAG = b"streamview/stamped"
+
+def encode_frames(m, colormodel = None, sent = None):
+    parts = [FRAMES_TAG]
+    for name, img in m.items():
+        img = np.ascontiguousarray(img)
+        header = {"name" : name, "shape" : img.shape, "dtype" : img.dtype.str, "ts" : time.time(),
+            "color" : "gray" if img.ndim == 2 else colormodel}
+        if sent is not None:
+            header["sent"] = sent
+        parts += [json.dumps(header).encode(), img]
+    return parts
+
+def decode_frames(parts):
+    m, meta = {}, {}
+    for hframe, bframe in zip(parts[1::2], parts[2::2]):
+        header = json.loads(bytes(hframe.buffer))
+        name = header["name"]
+        m[name] = np.frombuffer(bframe.buffer, dtype = np.dtype(header["dtype"])).reshape(header["shape"]) # no copy - view on zmq frame
+        meta[name] = header
+    return m, meta
+
 class iMsg(object):
-    def __init__(self, context, queue, host="127.0.0.1", fltr="", conflate=False):
+    def __init__(self, context, queue, host="127.0.0.1", fltr="", conflate=False, hwm=None):
         self.context = context
+        self.conflate = conflate
+        self.meta = {} # frame headers of last binary message, by stream name
+        self.sent = None     # publisher send time of the last message, if stamped
+        self.received = None # time.monotonic() at receive of the last message
+        self.port = queue
         self.sock = self.context.socket(zmq.SUB)
         if conflate == True:
-            self.sock.setsockopt(zmq.CONFLATE, 1)  # latest 1 message
+            self.sock.setsockopt(zmq.RCVHWM, 2) # ZMQ_CONFLATE does not support multipart - keep queue short and skip to latest in read
+        elif hwm is not None:
+            self.sock.setsockopt(zmq.RCVHWM, hwm) # bound memory use of the receive queue
         self.sock.connect("tcp://{}:{}".format(host, queue))
         self.sock.setsockopt_string(zmq.SUBSCRIBE, fltr)
 
+    def recv(self):
+        t0 = time.perf_counter()
+        try:
+            parts = self.sock.recv_multipart(flags=zmq.NOBLOCK, copy=False)
+        except zmq.Again:
+            return None
+        self.received = time.monotonic()
+        t0 = metrics.timed('streamview_receive_seconds', t0, port = self.port)
+        metrics.inc('streamview_messages_total', port = self.port)
+        message, self.sent = None, None
+        if len(parts) == 1: # legacy format
+            self.meta = {}
+            message = pickle.loads(parts[0].buffer)
+        elif parts[0].bytes == FRAMES_TAG:
+            message, self.meta = decode_frames(parts)
+            self.sent = next((header["sent"] for header in self.meta.values() if "sent" in header), None)
+        elif parts[0].bytes == STAMPED_TAG:
+            self.meta = {}
+            self.sent = json.loads(bytes(parts[1].buffer))["sent"]
+            message = pickle.loads(parts[2].buffer)
+        metrics.timed('streamview_unpickle_seconds', t0, port = self.port)
+        if self.sent is not None and isinstance(message, dict):
+            for name in message:
+                metrics.observe('streamview_latency_receive_seconds', self.received - self.sent, stream = name)
+        return message
+
     def read(self):
         try:
-            message = self.sock.recv_pyobj(flags=zmq.NOBLOCK)
-        except:
+            message = self.recv()
+            while self.conflate and message is not None: # conflate: skip to latest queued message
+                latest = self.recv()
+                if latest is None:
+                    break
+                message = latest
+        except Exception:
             return None
         else:
             return message
 
 class oMsg(object):
-    def __init__(self, context, queue, host = "127.0.0.1", conflate=False):
+    def __init__(self, context, queue, host = "127.0.0.1", conflate=False, binary=False, colormodel='rgb', stamp=False): # stamp: add send time, for latency measurement
         self.context = context
+        self.binary = binary
+        self.stamp = stamp
+        self.colormodel = colormodel
         self.sock = self.context.socket(zmq.PUB)
         if conflate == True:
-            self.sock.setsockopt(zmq.CONFLATE, 1)  # latest 1 message
+            if binary or stamp:
+                self.sock.setsockopt(zmq.SNDHWM, 2) # ZMQ_CONFLATE does not support multipart
+            else:
+                self.sock.setsockopt(zmq.CONFLATE, 1)  # latest 1 message
         self.sock.bind("tcp://{}:{}".format(host, queue))
 
-    def send(self, m):
-        self.sock.send_pyobj(m, protocol = 2) # use protocol 2 so we are compatible with ROS & python2
+    def send(self, m, track = False): # track: binary messages return a zmq.MessageTracker, done when zmq no longer holds the buffers
+        sent = time.monotonic() if self.stamp else None
+        if self.binary and isinstance(m, dict) and len(m) > 0 and all(isinstance(v, np.ndarray) for v in m.values()):
+            return self.sock.send_multipart(encode_frames(m, self.colormodel, sent), copy=False, track=track) # zero copy - buffers are sent as is
+        elif self.stamp:
+            self.sock.send_multipart([STAMPED_TAG, json.dumps({"sent" : sent}).encode(), pickle.dumps(m, protocol = 2)])
+        else:
+            self.sock.send_pyobj(m, protocol = 2) # use protocol 2 so we are compatible with ROS & python2
@@ -1,61 +1,170 @@
 import sys
 import cv2
+import zmq
 import time
+import threading
+import concurrent.futures
 import numpy as np
 import math
 import util
+import metrics
+
+############################################################################
+# Image preprocessing - conversion to BGR
+############################################################################
+def tobgr(img, colormodel, dst = None): # dst: optional destination, e.g. a canvas region
+    if len(img.shape) == 2:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR, dst = dst)
+    if colormodel == 'rgb':
+        return cv2.cvtColor(img, cv2.COLOR_RGB2BGR, dst = dst)
+    if dst is not None:
+        dst[:] = img
+        return dst
+    return img
+
+############################################################################
+# Resize plan - how to get an image of a given size to its display size:
+# halve with pyrDown while that stays at or above the target, then one
+# resize. computed once per layout ( and source size ), applied straight
+# into the destination - no full size intermediate copy. intermediate
+# images go to buffers allocated with the plan, so frames allocate nothing
+############################################################################
+class ResizePlan(object):
+
+    def __init__(self, srcshape, dtype, size): # srcshape: source image shape. size: target height, width
+        self.srcshape = tuple(srcshape)
+        self.dtype = dtype
+        self.size = tuple(size)
+        h, w = self.srcshape[:2]
+        self.pyr = [] # pyrDown destinations
+        while (h > size[0] or w > size[1]) and (h + 1) // 2 >= size[0] and (w + 1) // 2 >= size[1]: # pyrDown output is rounded up
+            h, w = (h + 1) // 2, (w + 1) // 2
+            self.pyr.append(np.empty((h, w) + self.srcshape[2:], dtype = dtype))
+        self.resize = (h, w) != self.size
+        self.interpolation = cv2.INTER_AREA if h * w > size[0] * size[1] else cv2.INTER_LINEAR
+        self.small = np.empty(self.size + self.srcshape[2:], dtype = dtype) if self.resize else None # resized, before color conversion
+
+    def apply(self, img, colormodel, dst, name = None): # convert and scale img into dst ( BGR, target size ). name: stream, for metrics
+        t0 = time.perf_counter()
+        for buf in self.pyr:
+            img = cv2.pyrDown(img, dst = buf, dstsize = (buf.shape[1], buf.shape[0]))
+        if self.resize:
+            if len(img.shape) == 3 and colormodel != 'rgb': # already BGR - resize straight into dst
+                img = cv2.resize(img, (self.size[1], self.size[0]), dst = dst, interpolation = self.interpolation)
+                metrics.timed('streamview_resize_seconds', t0, stream = name)
+                return img
+            img = cv2.resize(img, (self.size[1], self.size[0]), dst = self.small, interpolation = self.interpolation) # convert the small image
+        t0 = metrics.timed('streamview_resize_seconds', t0, stream = name)
+        img = tobgr(img, colormodel, dst)
+        metrics.timed('streamview_convert_seconds', t0, stream = name)
+        return img
+
+############################################################################
+# Receive and decode images on a background thread. the socket is drained
+# on every wake-up and only the newest image per stream is handed over
+# through the mailbox ( = per stream conflation ), with their receive time.
+# images are converted and scaled by VideoSet.flush, only when displayed
+############################################################################
+class VideoReceiver(threading.Thread):
+
+    def __init__(self, source, videocolormodel = 'rgb', record = None):
+        super().__init__(daemon = True)
+        self.source = source # util.iMsg - only used by this thread from now on
+        self.videocolormodel = videocolormodel
+        self.record = record # optional callback, receives every raw message
+        self.mailbox = util.Mailbox()
+        self.count = 0
+        self.running = True
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self.source.sock, zmq.POLLIN)
+        while self.running:
+            if not poller.poll(timeout = 100): # timeout: check for stop now and then
+                continue
+            images = {}
+            while True:
+                message = self.source.read()
+                if message is None:
+                    break
+                self.count += 1
+                if self.record is not None:
+                    self.record(message)
+                for name, image in message.items():
+                    metrics.inc('streamview_video_frames_total', stream = name)
+                    if name in images:
+                        metrics.inc('streamview_video_dropped_total', stream = name)
+                    images[name] = (image, self.source.meta.get(name, {}).get("color") or self.videocolormodel, self.source.received)
+            for name, image in images.items():
+                if self.mailbox.put(name, image): # the previous one was never taken
+                    metrics.inc('streamview_video_dropped_total', stream = name)
+
+    def stop(self):
+        self.running = False
+        self.join()
 
 ############################################################################
 # Video
 ############################################################################
 class Video(object):
 
-    def __init__(self, name, canvas, box):
+    def __init__(self, name, canvas, box, size): # size: displayed height, width
         self.canvas = canvas
         self.name = name
         self.lab = name
         self.box = box
+        self.size = size
+        self.plan = None
 
-    def update(self, img):
-        self.box.tobox(img)
+    def move(self, xoffs, yoffs): # same size, new place. keeps the resize plan
+        self.box.move(xoffs, yoffs)
+
+    def update(self, img, colormodel): # convert and scale img straight into the canvas. returns damaged area
+        if self.plan is None or self.plan.srcshape != img.shape or self.plan.dtype != img.dtype:
+            self.plan = ResizePlan(img.shape, img.dtype, self.size)
+        x, y = self.box.sbxoffs(), self.box.sbyoffs()
+        h, w = self.size
+        self.plan.apply(img, colormodel, self.canvas[y : y + h, x : x + w], self.name)
+        return (x, y, w, h)
 
 ############################################################################
 # VideoSet
 ############################################################################
 class VideoSet(object):
 
-    def __init__(self, canvas, box, cols = 3, videocolormodel = 'rgb'):
+    def __init__(self, canvas, box, cols = 3, videocolormodel = 'rgb', scale = 1, workers = 0, reserve = 0): # workers: threads converting streams in parallel. reserve: canvas rows kept for graphs
         self.canvas = canvas
         self.box = box
         self.cols = cols
         self.rows = 0
         self.videos = {}
-        self.images = {}
+        self.images = {}  # latest image per stream, as received
+        self.colormodels = {}
+        self.pending = {} # name : (image, colormodel) received since the last flush
         self.is_bgr = {}
         self.blocked = {}
         self.videocolormodel = videocolormodel
+        self.scale = scale
+        self.reserve = reserve
+        # cv2 releases the GIL and every stream writes its own canvas region, so streams can be processed in parallel
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "video") if workers > 1 else None
         self.redrawn = False # used by streamer - if videos are redrawn, graphs need to be redrawn as well 
 
     ############################################################################
     # handle new incoming video image
     ############################################################################
-    def update(self, name, img, wipemain): # handle new incoming video image
+    def update(self, name, img, wipemain, colormodel = None): # handle new incoming video image. colormodel: as sent in frame header, if any
         if self.cols == 0:
             return
         if name in self.blocked:
             return
-        if len(img.shape) == 2:
-           self.images[name] = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-        if len(img.shape) == 3:
-           if self.videocolormodel == 'rgb':
-               #print("rgb2brg")
-               self.images[name] = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-           else:
-               self.images[name] = img
+        resized = name in self.images and self.images[name].shape[:2] != img.shape[:2]
+        self.images[name] = img
+        self.colormodels[name] = colormodel or self.videocolormodel
 
         # set flag when video display has resized - tells graph display to resize as well
 
-        self.redrawn = True if (name not in self.videos and not name in self.blocked) else False
+        self.redrawn = True if ((name not in self.videos or resized) and not name in self.blocked) else False
 
         if self.redrawn:
             wipemain()
@@ -72,40 +181,70 @@ class VideoSet(object):
                    height = self.redraw(None, oldvideos = self.videos, newvideos = self.videos)
                    self.box.sizeme(height)
 
-        if name in self.videos and not name in self.blocked:
-            self.videos[name].update(self.images[name])
+        if self.redrawn: # new boxes - show the latest image of every stream
+            self.pending = {n : (self.images[n], self.colormodels[n]) for n in self.videos}
+        elif name in self.videos and not name in self.blocked:
+            if name in self.pending:
+                metrics.inc('streamview_video_dropped_total', stream = name)
+            self.pending[name] = (img, self.colormodels[name]) # replaces frames that were never displayed
+
+    def size(self, name): # displayed image height, width
+        img = self.images[name]
+        return (round(self.scale * img.shape[0]), round(self.scale * img.shape[1])) if self.scale != 1 else img.shape[:2]
 
     ############################################################################
-    # rebuild video display - happens when we see new videos
+    # rebuild video display - happens when we see new videos. images are
+    # scaled down to fit their cell width, and all of them together to fit
+    # the canvas height, less the rows reserved for graphs. videos that keep
+    # their size are moved, not rebuilt
     ############################################################################
     def redraw(self, newname, oldvideos, newvideos)  :
         self.overflow = False
         self.box.wipe()
-        videonames = sorted(list(oldvideos.keys()) if newname is None else (list(oldvideos.keys()) + ([newname])), key = lambda k: (self.images[k].shape[0], k))
+        videonames = sorted(set(oldvideos) | ({newname} if newname is not None else set()), key = lambda k: (self.size(k)[0], k)) # newname is known if it changed size
         self.rows = math.ceil(len(videonames) / self.cols)
+        w = math.floor(self.box.sbwidth()/self.cols)
+        rownames = [videonames[row * self.cols : (row+1) * self.cols] for row in range(0, self.rows)]
+
+        probe = util.Box(None, "", 0, 0, w, -1, border = True) # title and border space around a one pixel high image
+        fit = {name : min(1, (w - 2 * probe.sidemargin) / self.size(name)[1]) for name in videonames}
+        rowheights = [max([self.size(name)[0] * fit[name] for name in names]) for names in rownames]
+        available = self.canvas.shape[0] - self.box.sbyoffs() - self.reserve - self.rows * (probe.height - 1)
+        shrink = min(1, available / max(1, sum(rowheights)))
+        sizes = {name : (max(1, math.floor(self.size(name)[0] * fit[name] * shrink)), max(1, math.floor(self.size(name)[1] * fit[name] * shrink))) for name in videonames}
+
         height = 0
-        for row in range(0, self.rows):
-            imgheight = max([self.images[videonames[i]].shape[0]
-                for i in range(row * self.cols , min(len(videonames), (row+1) * self.cols))])
+        for names in rownames:
+            imgheight = max([sizes[name][0] for name in names])
             rowbox = util.Box(None, "", self.box.sbxoffs(), self.box.sbyoffs() + height, self.box.sbwidth(), -1 * imgheight, border = True) # negative height : let box add the title height
-            w = math.floor(self.box.sbwidth()/self.cols)
             h = rowbox.height
-            for col in range(0, self.cols):
-                idx = row * self.cols + col % self.cols
-                if idx < len(videonames):
-                   name = videonames[idx]
-                   img = self.images[name]
-                   box = util.Box(self.canvas, name, self.box.sbxoffs() + col * w, self.box.sbyoffs() + height, w, h,
-                       topbotmargin = math.floor((rowbox.sbheight() - img.shape[0])/2), sidemargin = math.floor((w - img.shape[1])/2), border = True)
-                   if box.overflow is True:
-                       self.overflow = True
-                   newvideos[name] = Video(name, self.canvas, box)
+            for col, name in enumerate(names):
+                imgh, imgw = sizes[name]
+                box = util.Box(self.canvas, name, self.box.sbxoffs() + col * w, self.box.sbyoffs() + height, w, h,
+                    topbotmargin = math.floor((rowbox.sbheight() - imgh)/2), sidemargin = math.floor((w - 2 * probe.sidemargin - imgw)/2), border = True)
+                if box.overflow is True or available < self.rows:
+                    self.overflow = True
+                old = oldvideos.get(name)
+                if old is not None and old.size == sizes[name] and (old.box.width, old.box.height, old.box.topbotmargin, old.box.sidemargin) == (w, h, box.topbotmargin, box.sidemargin):
+                    old.move(box.xoffs, box.yoffs)
+                    newvideos[name] = old
+                    continue
+                newvideos[name] = Video(name, self.canvas, box, sizes[name])
             height += rowbox.height
         return height
 
     def count(self):
        return len(self.videos)
 
-    def flush(self):
+    def flush(self): # only new images are converted and scaled into the canvas - once per displayed frame. returns list of damaged areas
+        jobs = [(self.videos[name], img, colormodel) for name, (img, colormodel) in self.pending.items() if name in self.videos]
+        self.pending = {}
+        if self.pool is not None and len(jobs) > 1:
+            damage = list(self.pool.map(lambda job: job[0].update(job[1], job[2]), jobs))
+        else:
+            damage = [video.update(img, colormodel) for video, img, colormodel in jobs]
         for name in self.videos.keys():
-            self.videos[name].box.flush()
+            d = self.videos[name].box.flush()
+            if d is not None:
+                damage.append(d)
+        return damage